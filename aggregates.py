@@ -0,0 +1,287 @@
+import math
+import os
+import shutil
+from statistics import NormalDist
+import numpy as np
+import polars as pl
+import streamlit as st
+import data_cleaning
+import moments
+import quantiles
+
+AGGREGATES_DIR = os.path.join(data_cleaning.CACHE_DIR, "aggregates") # Cartella con le tabelle aggregate già calcolate
+
+
+# Restituisce un gruppo di tabelle aggregate (dizionario nome -> DataFrame) per una versione del dataset.
+# Se il gruppo è già stato salvato su disco viene solo letto (mappato in memoria), altrimenti viene calcolato
+# con compute() e salvato in aggregates/<prefisso>.<versione>/<gruppo>/, una tabella Arrow IPC per ogni nome.
+# Il prefisso identifica il dataset (csv ed età esclusa, vedi data_cleaning.get_cache_prefix).
+def materialize(group, version, compute, file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    prefix = data_cleaning.get_cache_prefix(file_name, excluded_age)
+    folder = os.path.join(AGGREGATES_DIR, f"{prefix}.{version}", group)
+    if os.path.isdir(folder):
+        return {
+            os.path.splitext(file)[0]: pl.read_ipc(os.path.join(folder, file), memory_map=True)
+            for file in sorted(os.listdir(folder))
+        }
+    results = compute()
+    try:
+        _write_group(folder, prefix, results)
+    except OSError: # Cartella non scrivibile: le tabelle restano solo in memoria
+        pass
+    return results
+
+
+# Scrive le tabelle in una cartella temporanea e la rinomina alla fine: se la cartella del gruppo esiste
+# è sicuramente completa (anche con più processi che calcolano lo stesso gruppo in contemporanea)
+def _write_group(folder, prefix, results):
+    tmp_folder = f"{folder}.{os.getpid()}.tmp"
+    os.makedirs(tmp_folder, exist_ok=True)
+    for name, table in results.items():
+        table.write_ipc(os.path.join(tmp_folder, f"{name}.arrow"), compression="uncompressed")
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError: # Un altro processo ha già scritto lo stesso gruppo
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    # Rimuove le tabelle delle versioni precedenti dello stesso dataset (quelle degli altri dataset restano)
+    current = os.path.basename(os.path.dirname(folder))
+    for old_version in os.listdir(AGGREGATES_DIR):
+        if old_version.startswith(f"{prefix}.") and old_version != current:
+            shutil.rmtree(os.path.join(AGGREGATES_DIR, old_version), ignore_errors=True)
+
+
+
+
+
+### ANALISI ESPLORATIVA SULLE ABITUDINI MUSICALI
+
+# Piani lazy per i grafici statici della pagina (nessuno dipende dai selettori).
+# L'ordine dei generi del boxplot viene invece ricavato dalle mediane degli sketch dei quantili (vedi genre_order).
+def _music_habits_plans(data):
+    # Istogramma delle età: filtraggio dei dati per escludere valori estremi, altrimenti l'istogramma avrebbe una serie di valori nulli
+    # fino all'outlier 80 anni.
+    data_age_hist = (
+        data.filter(pl.col("Age") <= 70)  # Filtra le età <= 70
+        .group_by("Age")  # Raggruppa per età
+        .agg(pl.len().alias("Count"))  # Conta il numero di risposte per età
+        .with_columns(
+            (pl.col("Count") / pl.col("Count").sum() * 100).alias("Percentage")  # Calcola le percentuali
+        )
+    )
+
+    # Tabella per le età escluse dall'istogramma
+    freq_removed = (
+        data.filter(pl.col("Age") > 70)  # Filtro età > 70 anni
+        .group_by("Age") # Raggruppa per età
+        .agg(pl.len().alias("Frequency")) # Conta le frequenze
+        .sort("Age")  # Ordina per età in ordine crescente
+    )
+
+    # Grafico a torta: distribuzione delle piattaforme
+    data_platform_pie = (
+        data.filter(pl.col("Primary streaming service").is_not_null())  # Rimuove valori nulli
+        .group_by("Primary streaming service")  # Raggruppamento per piattaforma
+        .agg(pl.len().alias("Users"))  # Conteggio delle unità
+        .with_columns((pl.col("Users") / pl.col("Users").sum() * 100).alias("Percentage"))  # Calcolo percentuali
+        .with_columns((pl.col("Percentage").round(2).cast(pl.String) + "%").alias("Percentage_Label"))  # Aggiunge il simbolo "%"
+    )
+
+    # Area plot: ore medie di ascolto per età
+    processed_data = (
+        data.group_by("Age")  # Raggruppa i dati per età
+        .agg(pl.mean("Hours per day").alias("Avg hours per day"))  # Calcola la media delle ore per ogni gruppo
+        .sort("Age")  # Ordina i dati per età (crescente)
+    )
+
+    # Conta il numero di preferenze per ciascun genere musicale nella colonna 'Fav genre'
+    # (non ci sono dati mancanti, quindi la somma dei conteggi è il totale degli utenti)
+    genre_counts = (
+        data.group_by('Fav genre')
+        .agg(pl.len().alias('Conteggio'))
+        .with_columns(
+            (pl.col('Conteggio') / pl.col('Conteggio').sum() * 100).alias('Percentuale')
+        )
+        .sort('Conteggio', descending=True)
+    )
+
+    return {
+        "data_age_hist": data_age_hist,
+        "freq_removed": freq_removed,
+        "data_platform_pie": data_platform_pie,
+        "processed_data": processed_data,
+        "genre_counts": genre_counts
+    }
+
+
+# Cache in memoria condivisa tra le sessioni, indicizzata sulla versione del dataset
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _music_habits_aggregates(version, file_name, excluded_age):
+    def compute():
+        plans = _music_habits_plans(data_cleaning.get_data_lazy(file_name, excluded_age))
+        results = dict(zip(plans, pl.collect_all(list(plans.values())))) # Esegue tutti i piani insieme
+        results["order"] = genre_order(get_hours_boxplot_stats(file_name, excluded_age)[0])
+        return results
+    return materialize("music_habits", version, compute, file_name, excluded_age)
+
+
+# Tabelle aggregate della pagina sulle abitudini musicali: calcolate una sola volta per versione del dataset
+def get_music_habits_aggregates(file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _music_habits_aggregates(version, file_name, excluded_age)
+
+
+# Cubo (genere x livello di frequenza) con conteggi e percentuali per tutte le 16 colonne "Frequency [genere]",
+# calcolato con un solo passaggio sui dati (unpivot + un'unica aggregazione)
+def _frequency_cube_plan(data):
+    frequency_columns = [col for col in data.collect_schema().names() if col.startswith("Frequency [")]
+    genres = [col.replace("Frequency [", "").replace("]", "") for col in frequency_columns] # Generi nell'ordine delle colonne
+    return (
+        data.select(frequency_columns)
+        .unpivot(on=frequency_columns, variable_name="Genere", value_name="Frequenza")
+        .with_columns(pl.col("Genere").str.strip_prefix("Frequency [").str.strip_suffix("]"))
+        .group_by("Genere", "Frequenza")
+        .agg(pl.len().alias("Conteggio"))
+        .with_columns(
+            (pl.col("Conteggio") / pl.col("Conteggio").sum().over("Genere") * 100).alias("Percentuale") # Percentuale sul totale del genere
+        )
+        .sort(pl.col("Genere").cast(pl.Enum(genres)), "Frequenza", nulls_last=True)
+    )
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _frequency_cube(version, file_name, excluded_age):
+    def compute():
+        return {"frequency_cube": _frequency_cube_plan(data_cleaning.get_data_lazy(file_name, excluded_age)).collect()}
+    cube = materialize("genre_frequency", version, compute, file_name, excluded_age)["frequency_cube"]
+    # Il cubo viene anche diviso per genere: cambiare genere nel selettore è una semplice lettura dal dizionario
+    by_genre = {
+        genre: table.select("Frequenza", "Conteggio", "Percentuale")
+        for (genre,), table in cube.partition_by("Genere", as_dict=True, maintain_order=True).items()
+    }
+    return cube, by_genre
+
+
+# Restituisce il cubo completo (utile per viste con tutti i generi insieme)
+def get_frequency_cube(file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _frequency_cube(version, file_name, excluded_age)[0]
+
+
+# Restituisce il dizionario genere -> tabella (Frequenza, Conteggio, Percentuale), con i generi nell'ordine delle colonne
+def get_frequency_by_genre(file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _frequency_cube(version, file_name, excluded_age)[1]
+
+
+# Ordina i generi del boxplot in base alla mediana delle ore di ascolto, poi alfabeticamente
+# (in quanto ci sono più generi che hanno mediana uguale)
+def genre_order(stats, group="Fav genre"):
+    return stats.sort("median", group).select(group)
+
+
+# Le statistiche vengono calcolate dagli sketch dei quantili (quantiles.py): esatti finché i valori distinti delle ore
+# sono pochi (come nel csv), approssimati con errore limitato per export molto grandi, senza ordinare tutti i valori
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _hours_boxplot_stats(version, file_name, excluded_age):
+    def compute():
+        data = data_cleaning.get_data_lazy(file_name, excluded_age)
+        sketches = quantiles.grouped_sketches(data, "Fav genre", "Hours per day")
+        stats, outliers = quantiles.box_stats_from_sketches(sketches, "Fav genre", "Hours per day")
+        return {"stats": stats, "outliers": outliers}
+    return materialize("hours_boxplot", version, compute, file_name, excluded_age)
+
+
+# Statistiche del boxplot delle ore di ascolto per genere preferito
+def get_hours_boxplot_stats(file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    tables = _hours_boxplot_stats(version, file_name, excluded_age)
+    return tables["stats"], tables["outliers"]
+
+
+# Quantile p della distribuzione t di Student con df gradi di libertà (vettorizzato su df).
+# Per df = 1 e df = 2 si usano le formule esatte, altrimenti l'espansione di Cornish-Fisher attorno al quantile
+# della normale (errore relativo di circa 1e-3 per df = 3 e sempre più piccolo al crescere di df), così non serve scipy.
+def t_quantile(p, df):
+    df = np.asarray(df, dtype=float)
+    valid = df >= 1
+    safe_df = np.where(valid, df, 1.0) # Con df < 1 (una sola risposta) l'espansione non viene valutata: niente divisioni per zero
+    z = NormalDist().inv_cdf(p)
+    t = (
+        z
+        + (z ** 3 + z) / (4 * safe_df)
+        + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * safe_df ** 2)
+        + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * safe_df ** 3)
+        + (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / (92160 * safe_df ** 4)
+    )
+    t = np.where(df == 1, math.tan(math.pi * (p - 0.5)), t)
+    t = np.where(df == 2, (2 * p - 1) / math.sqrt(2 * p * (1 - p)), t)
+    return np.where(valid, t, np.nan)
+
+
+# Cubo (genere preferito x condizione psichica) con numero di rispondenti, media, varianza, mediana e
+# intervallo di confidenza della media basato sulla t di Student, calcolato con una sola aggregazione
+def _genre_condition_cube_plan(data, conditions):
+    return (
+        data.filter(pl.col("Fav genre").is_not_null() & pl.all_horizontal(pl.col(conditions).is_not_null())) # Rimuove i valori nulli
+        .unpivot(index=["Fav genre"], on=conditions, variable_name="Condition", value_name="Level")
+        .group_by("Fav genre", "Condition")
+        .agg(
+            pl.len().alias("count"),
+            pl.col("Level").mean().alias("mean"),
+            pl.col("Level").var().alias("variance"),
+            pl.col("Level").median().alias("median")
+        )
+        .sort("Fav genre", "Condition")
+    )
+
+
+def _add_confidence_interval(cube, confidence):
+    count = cube["count"].to_numpy()
+    t = t_quantile(0.5 + confidence / 2, count - 1)
+    half_width = pl.Series("half_width", t) * (pl.col("variance") / pl.col("count")).sqrt()
+    return cube.with_columns(
+        (pl.col("mean") - half_width).alias("ci_low"), # Estremo inferiore dell'intervallo
+        (pl.col("mean") + half_width).alias("ci_high") # Estremo superiore dell'intervallo
+    )
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _genre_condition_cube(version, conditions, confidence, file_name, excluded_age):
+    def compute():
+        data = data_cleaning.get_data_lazy(file_name, excluded_age)
+        cube = _genre_condition_cube_plan(data, list(conditions)).collect()
+        return {"cube": _add_confidence_interval(cube, confidence)}
+    group = f"genre_condition.{'_'.join(conditions)}.{confidence}"
+    return materialize(group, version, compute, file_name, excluded_age)["cube"]
+
+
+# Statistiche per genere preferito e condizione psichica, calcolate una sola volta per versione del dataset
+def get_genre_condition_cube(conditions=("Depression", "Anxiety", "OCD", "Insomnia"), confidence=0.95,
+                             file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _genre_condition_cube(version, tuple(conditions), confidence, file_name, excluded_age)
+
+
+# Matrice di correlazione di Pearson (valori mancanti gestiti a coppie) in formato long: una riga per ogni coppia
+# (Variable1, Variable2) con la correlazione e il numero di righe usate
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _correlation_table(version, columns, file_name, excluded_age):
+    def compute():
+        data = data_cleaning.get_data_lazy(file_name, excluded_age).select(columns).collect() # Solo le colonne richieste
+        accumulator = moments.pairwise_moments(data, columns)
+        return {"correlation": pl.DataFrame({
+            "Variable1": np.repeat(columns, len(columns)),
+            "Variable2": np.tile(columns, len(columns)),
+            "Correlation": accumulator.correlation().ravel(),
+            "count": accumulator.count.ravel().astype(np.int64)
+        })}
+    group = f"correlation.{'_'.join(columns)}"
+    return materialize(group, version, compute, file_name, excluded_age)["correlation"]
+
+
+# Correlazioni tra le colonne indicate (es. condizioni psichiche, ore di ascolto, età, BPM), calcolate una sola volta
+# per versione del dataset
+def get_correlation_table(columns, file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _correlation_table(version, tuple(columns), file_name, excluded_age)
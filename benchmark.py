@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import polars as pl
+import aggregates
+import charts
+import data_cleaning
+import ingestion
+import kde
+import moments
+import ols
+import quantiles
+import synthetic
+
+SCALES = [1, 10, 100, 1000] # Copie del csv: 1 è il file originale, le altre sono copie ingrandite
+PSYCH_CONDITIONS = ["Anxiety", "Depression", "Insomnia", "OCD"] # Condizioni della pagina sulle condizioni psichiche
+PAGES = [
+    "Introduzione.py",
+    "pages/Analisi_esplorativa_sulle_abitudini_musicali.py",
+    "pages/Analisi_esplorativa_sulle_condizioni_psichiche.py",
+    "pages/Analisi_incrociate.py"
+]
+BENCHMARK_DIR = os.path.join(data_cleaning.CACHE_DIR, "benchmark") # Copie ingrandite del csv
+
+
+# Benchmark del costo di una riesecuzione delle pagine: caricamento dei dati, ogni blocco di aggregazione e la
+# preparazione delle specifiche dei grafici (Altair e Plotly), sul csv originale e su copie ingrandite.
+# I risultati sono righe JSON (una per misura), da salvare e confrontare nel tempo:
+# {"scale", "rows", "kind", "name", "repeat", "median_s", "min_s", "max_s", ...}
+#   uv run python benchmark.py --scales 1 10 100 --repeat 5 --out risultati.jsonl
+
+
+# Copia ingrandita del csv, creata una sola volta: le righe ripetute scale volte oppure, con generated=True,
+# scale volte il numero di righe generate con synthetic.py (valori diversi ma stesse distribuzioni e correlazioni)
+def scaled_copy(scale, file_name=data_cleaning.FILE_NAME, generated=False):
+    path = data_cleaning.get_data_path(file_name)
+    if scale == 1:
+        return path
+    kind = "synthetic" if generated else "x"
+    scaled = os.path.join(BENCHMARK_DIR, f"{os.path.splitext(os.path.basename(path))[0]}_{kind}{scale}.csv")
+    if not os.path.exists(scaled):
+        os.makedirs(BENCHMARK_DIR, exist_ok=True)
+        raw = pl.read_csv(path, schema_overrides=data_cleaning.DTYPES)
+        tmp_path = f"{scaled}.{os.getpid()}.tmp.csv"
+        if generated:
+            synthetic.generate(tmp_path, raw.height * scale, model=synthetic.SurveyModel(raw))
+        else:
+            pl.concat([raw] * scale).write_csv(tmp_path)
+        os.replace(tmp_path, scaled)
+    return scaled
+
+
+# Esegue function repeat volte e restituisce l'ultimo risultato e i tempi (in secondi)
+def _time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def _record(scale, rows, kind, name, times, **extra):
+    return {
+        "scale": scale,
+        "rows": rows,
+        "kind": kind,
+        "name": name,
+        "repeat": len(times),
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        **extra
+    }
+
+
+### BLOCCHI DI AGGREGAZIONE (stessi calcoli delle pagine, senza cache)
+
+def _boxplot_order(data):
+    sketches = quantiles.grouped_sketches(data, "Fav genre", "Hours per day")
+    stats, outliers = quantiles.box_stats_from_sketches(sketches, "Fav genre", "Hours per day")
+    return aggregates.genre_order(stats), stats, outliers
+
+
+def _melt_density(data):
+    long_data = (
+        data.select(PSYCH_CONDITIONS)
+        .unpivot(on=PSYCH_CONDITIONS, variable_name="Condition", value_name="Value")
+        .filter(pl.col("Value").is_not_null())
+        .collect()
+    )
+    return long_data, kde.kde_table(data.select(PSYCH_CONDITIONS).collect(), PSYCH_CONDITIONS, extent=(-3, 14), steps=171)
+
+
+def _bubble(data):
+    by, values = ingestion.GROUPED_SUMS["age"]
+    sums = moments.grouped_sums(data.select(*by, *values).collect(), by, values)
+    return [moments.grouped_mean_variance(sums, "Age", condition) for condition in PSYCH_CONDITIONS]
+
+
+def _correlation(data):
+    return moments.pairwise_moments(data.select(PSYCH_CONDITIONS).collect(), PSYCH_CONDITIONS).correlation()
+
+
+def _ols_fit_predict(data, grid_steps=10):
+    conditions = ["Depression", "Anxiety", "OCD", "Insomnia"]
+    survey_moments = moments.MomentAccumulator(ingestion.MOMENT_COLUMNS).update(data.select(ingestion.MOMENT_COLUMNS).collect())
+    fit = ols.fit_ols_from_moments(survey_moments.cross_products(["Age", "Hours per day"] + conditions), 2)
+    x_grid, y_grid = np.meshgrid(
+        np.linspace(survey_moments.minimum[0], survey_moments.maximum[0], grid_steps),
+        np.linspace(survey_moments.minimum[1], survey_moments.maximum[1], grid_steps)
+    )
+    return ols.predict(fit, np.c_[x_grid.ravel(), y_grid.ravel()])
+
+
+def _heatmap(data):
+    cube = aggregates._genre_condition_cube_plan(data, ["Depression", "Anxiety", "OCD", "Insomnia"]).collect()
+    return aggregates._add_confidence_interval(cube, 0.95)
+
+
+def _scatter_3d(data):
+    frame = data.select("Age", "Hours per day", "Depression").drop_nulls(["Age", "Hours per day"]).collect()
+    return charts.downsample_3d(frame, "Age", "Hours per day", "Depression", keep=pl.col("Hours per day") > 10)
+
+
+def aggregation_blocks(data):
+    habits = aggregates._music_habits_plans(data)
+    return {
+        "age_histogram": lambda: pl.collect_all([habits["data_age_hist"], habits["freq_removed"]]),
+        "platform_pie": lambda: habits["data_platform_pie"].collect(),
+        "boxplot_order": lambda: _boxplot_order(data),
+        "area_hours_by_age": lambda: habits["processed_data"].collect(),
+        "genre_counts": lambda: habits["genre_counts"].collect(),
+        "frequency_counts": lambda: aggregates._frequency_cube_plan(data).collect(),
+        "melt_density": lambda: _melt_density(data),
+        "bubble_aggregation": lambda: _bubble(data),
+        "correlation": lambda: _correlation(data),
+        "ols_fit_predict": lambda: _ols_fit_predict(data),
+        "genre_heatmap": lambda: _heatmap(data),
+        "scatter_3d_sample": lambda: _scatter_3d(data)
+    }
+
+
+# Caricamento (lettura del csv, scrittura e lettura del sidecar) e blocchi di aggregazione su una copia del csv
+def run_blocks(path, scale, repeat):
+    records = []
+    data, times = _time(lambda: data_cleaning._read_csv_cleaned(path, data_cleaning.EXCLUDED_AGE), repeat)
+    rows = data.height
+    records.append(_record(scale, rows, "load", "read_csv", times))
+
+    with tempfile.TemporaryDirectory() as folder:
+        sidecar = os.path.join(folder, "data.arrow")
+        _, times = _time(lambda: data.write_ipc(sidecar, compression="uncompressed"), repeat)
+        records.append(_record(scale, rows, "load", "sidecar_write", times))
+        _, times = _time(lambda: pl.read_ipc(sidecar, memory_map=True), repeat)
+        records.append(_record(scale, rows, "load", "sidecar_read", times))
+
+        lazy = pl.scan_ipc(sidecar, memory_map=True) # Come get_data_lazy
+        for name, block in aggregation_blocks(lazy).items():
+            _, times = _time(block, repeat)
+            records.append(_record(scale, rows, "aggregate", name, times))
+    return records
+
+
+### PAGINE E SPECIFICHE DEI GRAFICI
+
+# Eseguito in un processo separato (con MXMH_FILE_NAME e MXMH_CACHE_DIR impostati): esegue ogni pagina con AppTest
+# repeat + 1 volte (la prima con le cache vuote) e misura ogni grafico: per Altair l'intera chiamata a
+# charts.altair_chart, per Plotly la serializzazione della figura passata a st.plotly_chart. Come per le pagine,
+# la prima esecuzione (spec_cold: per Altair compilazione della specifica) è registrata separatamente dalle
+# successive (spec_warm: per Altair lettura dalla cache), così la mediana non mescola i due casi.
+# Scrive le misure come righe JSON sullo standard output.
+def _page_worker(repeat):
+    import streamlit
+    from streamlit.testing.v1 import AppTest
+
+    charts_times = {} # (pagina, grafico) -> tempi e dimensione della specifica
+    current = {}
+
+    def measure(name, elapsed, size):
+        current["index"] += 1
+        entry = charts_times.setdefault((current["page"], f"{current['index']:02d} {name}"), {"times": [], "bytes": size})
+        entry["times"].append(elapsed)
+
+    def timed_altair(chart_id, build, version, state=(), **kwargs):
+        start = time.perf_counter()
+        result = original_altair(chart_id, build, version, state, **kwargs)
+        elapsed = time.perf_counter() - start
+        spec_json, datasets = charts._compiled_spec(chart_id, version, tuple(state), build) # Già nella cache
+        measure(chart_id, elapsed, len(spec_json) + sum(len(payload) for payload in datasets.values()))
+        return result
+
+    def timed_plotly(figure, *args, **kwargs):
+        start = time.perf_counter()
+        spec = figure.to_json()
+        measure(figure.layout.title.text or type(figure).__name__, time.perf_counter() - start, len(spec))
+        return original_plotly(figure, *args, **kwargs)
+
+    original_altair, charts.altair_chart = charts.altair_chart, timed_altair
+    original_plotly, streamlit.plotly_chart = streamlit.plotly_chart, timed_plotly
+
+    for page in PAGES:
+        page_times = []
+        for _ in range(repeat + 1):
+            current.update(page=page, index=0)
+            start = time.perf_counter()
+            app = AppTest.from_file(os.path.join(data_cleaning.BASE_DIR, page), default_timeout=600).run()
+            page_times.append(time.perf_counter() - start)
+            if app.exception:
+                raise RuntimeError(f"{page}: {app.exception[0].message}")
+        print(json.dumps({"kind": "page_cold", "name": page, "times": page_times[:1]}))
+        print(json.dumps({"kind": "page_warm", "name": page, "times": page_times[1:]}))
+    for (page, name), entry in charts_times.items():
+        name = f"{page}: {name}"
+        print(json.dumps({"kind": "spec_cold", "name": name, "times": entry["times"][:1], "bytes": entry["bytes"]}))
+        print(json.dumps({"kind": "spec_warm", "name": name, "times": entry["times"][1:], "bytes": entry["bytes"]}))
+
+
+def run_pages(path, scale, rows, repeat):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, MXMH_FILE_NAME=path, MXMH_CACHE_DIR=cache_dir)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--page-worker", "--repeat", str(repeat)],
+            env=env, cwd=data_cleaning.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout
+    records = []
+    for line in output.splitlines():
+        if line.startswith("{"):
+            measure = json.loads(line)
+            extra = {"spec_bytes": measure["bytes"]} if "bytes" in measure else {}
+            records.append(_record(scale, rows, measure["kind"], measure["name"], measure["times"], **extra))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di caricamento, aggregazioni e grafici delle pagine")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="Fattori di ingrandimento del csv")
+    parser.add_argument("--repeat", type=int, default=5, help="Ripetizioni di ogni misura")
+    parser.add_argument("--synthetic", action="store_true", help="Copie ingrandite con dati sintetici invece delle righe ripetute")
+    parser.add_argument("--no-pages", action="store_true", help="Salta l'esecuzione delle pagine")
+    parser.add_argument("--out", help="File in cui aggiungere i risultati (righe JSON); se assente vengono stampati")
+    parser.add_argument("--page-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.page_worker:
+        _page_worker(args.repeat)
+        return
+
+    run = {
+        "run": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count()
+    }
+    out = open(args.out, "a") if args.out else sys.stdout
+    try:
+        for scale in args.scales:
+            path = scaled_copy(scale, generated=args.synthetic)
+            records = run_blocks(path, scale, args.repeat)
+            if not args.no_pages:
+                records += run_pages(path, scale, records[0]["rows"], args.repeat)
+            for record in records:
+                out.write(json.dumps({**run, "synthetic": args.synthetic, **record}) + "\n")
+            out.flush()
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
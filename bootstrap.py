@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+import streamlit as st
+import data_cleaning
+
+N_BOOT = 2000 # Numero di ricampionamenti predefinito
+MAX_INDEX_CELLS = 4_000_000 # Celle della matrice degli indici generate per volta (limita la memoria: circa 32 MB)
+HISTOGRAM_RATIO = 4 # Si ricampionano i conteggi se le righe sono almeno HISTOGRAM_RATIO volte le coppie distinte
+WORKERS = min(4, os.cpu_count() or 1) # Thread usati per i blocchi di ricampionamenti
+MIN_CI_COUNT = 2 # Sotto questo numero di righe per gruppo l'intervallo non viene calcolato (ogni ricampionamento è identico)
+
+
+# Indice delle righe ordinate per gruppo, costruito una sola volta e riusato da tutti i ricampionamenti:
+# per ogni riga l'inizio e la dimensione del suo gruppo, così un ricampionamento stratificato (con reinserimento,
+# dentro ogni gruppo) è una sola matrice di indici start + intero casuale in [0, dimensione).
+# Con counts le righe sono i valori distinti di ogni gruppo con il loro conteggio: ricampionare le righe equivale
+# a estrarre i conteggi da una multinomiale, con un costo che dipende dai valori distinti e non dalle righe.
+class GroupIndex:
+    def __init__(self, groups, values, counts=None):
+        order = np.argsort(groups, kind="stable")
+        self.values = np.asarray(values, dtype=float)[order]
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.int64)[order]
+        self.keys, self.starts, rows = np.unique(np.asarray(groups)[order], return_index=True, return_counts=True)
+        row_group = np.repeat(np.arange(len(self.keys)), rows)
+        if self.counts is None:
+            self.sizes = rows
+            self.row_starts = self.starts[row_group]
+            self.row_sizes = self.sizes[row_group]
+        else:
+            # Valori e probabilità di ogni gruppo in una matrice gruppi x valori distinti (completata con zeri)
+            self.sizes = np.add.reduceat(self.counts, self.starts)
+            position = np.arange(len(self.values)) - self.starts[row_group]
+            self.table_values = np.zeros((len(self.keys), rows.max()))
+            self.table_values[row_group, position] = self.values
+            self.probabilities = np.zeros_like(self.table_values)
+            self.probabilities[row_group, position] = self.counts / self.sizes[row_group]
+
+    def means(self):
+        weighted = self.values if self.counts is None else self.values * self.counts
+        return np.add.reduceat(weighted, self.starts) / self.sizes
+
+    # Medie per gruppo di draws ricampionamenti (matrice draws x gruppi)
+    def resampled_means(self, draws, rng):
+        if self.counts is not None:
+            counts = rng.multinomial(self.sizes, self.probabilities, size=(draws, len(self.keys)))
+            return (counts * self.table_values).sum(axis=2) / self.sizes
+        index = self.row_starts + rng.integers(0, self.row_sizes, size=(draws, len(self.values)))
+        return np.add.reduceat(self.values[index], self.starts, axis=1) / self.sizes
+
+
+# Pesi del lisciamento con kernel gaussiano (Nadaraya-Watson) delle medie per gruppo sui punti della griglia:
+# ogni media pesa per il numero di rispondenti del gruppo, quindi i gruppi con una o due risposte contano poco
+def _smoothing_weights(keys, sizes, grid, bandwidth):
+    kernel = np.exp(-0.5 * ((grid[None, :] - keys[:, None].astype(float)) / bandwidth) ** 2)
+    weights = sizes[:, None] * kernel
+    return weights / weights.sum(axis=0)
+
+
+# Bootstrap stratificato della media di value per ogni gruppo di by (es. ore medie di ascolto per età).
+# I ricampionamenti vengono generati a blocchi come matrici di indici (nessun ciclo Python sui ricampionamenti),
+# ogni blocco con un proprio generatore derivato da seed: il risultato dipende solo da (dati, n_boot, seed),
+# non dal numero di thread. Se le coppie (gruppo, valore) distinte sono molte meno delle righe (es. età e ore di
+# ascolto su milioni di risposte) si ricampionano i conteggi dei valori distinti. Restituisce la tabella per gruppo (by, count, mean, ci_low, ci_high) e, se bandwidth
+# è indicata, la curva lisciata con la sua banda (by, mean, ci_low, ci_high) su una griglia di passo step.
+# Nei gruppi con meno di MIN_CI_COUNT righe ci_low e ci_high sono nulli: con una sola risposta il bootstrap
+# restituirebbe un intervallo di ampiezza zero, cioè la stima all'apparenza più certa invece della meno certa.
+def bootstrap_means(frame, by, value, n_boot=N_BOOT, seed=0, confidence=0.95, bandwidth=None, step=1.0, workers=1):
+    frame = frame.select(by, value).drop_nulls()
+    histogram = frame.group_by(by, value).agg(pl.len().alias("count"))
+    if histogram.height * HISTOGRAM_RATIO <= frame.height:
+        index = GroupIndex(histogram[by].to_numpy(), histogram[value].to_numpy(), histogram["count"].to_numpy())
+    else:
+        index = GroupIndex(frame[by].to_numpy(), frame[value].to_numpy())
+    smoothing = None
+    if bandwidth is not None:
+        grid = np.arange(index.keys.min(), index.keys.max() + step / 2, step, dtype=float)
+        smoothing = _smoothing_weights(index.keys, index.sizes, grid, bandwidth)
+
+    cells = len(index.values) if index.counts is None else index.table_values.size
+    draws = max(1, min(n_boot, MAX_INDEX_CELLS // max(cells, 1))) # Ricampionamenti per blocco
+    blocks = [min(draws, n_boot - start) for start in range(0, n_boot, draws)]
+    generators = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(blocks))]
+
+    def run(block, rng):
+        means = index.resampled_means(block, rng)
+        return means, (means @ smoothing if smoothing is not None else None)
+
+    if workers > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(run, blocks, generators))
+    else:
+        results = [run(block, rng) for block, rng in zip(blocks, generators)]
+
+    alpha = (1 - confidence) / 2
+    means = np.concatenate([result[0] for result in results])
+    low, high = np.quantile(means, [alpha, 1 - alpha], axis=0) # Intervallo percentile
+    point = index.means()
+    table = pl.DataFrame({
+        by: pl.Series(index.keys, dtype=frame.schema[by]),
+        "count": index.sizes,
+        "mean": point,
+        "ci_low": low,
+        "ci_high": high
+    }).with_columns(
+        pl.when(pl.col("count") >= MIN_CI_COUNT).then(pl.col("ci_low", "ci_high"))
+    )
+    if smoothing is None:
+        return table, None
+    curves = np.concatenate([result[1] for result in results])
+    low, high = np.quantile(curves, [alpha, 1 - alpha], axis=0)
+    smoothed = pl.DataFrame({by: grid, "mean": point @ smoothing, "ci_low": low, "ci_high": high})
+    return table, smoothed
+
+
+# Cache condivisa tra le sessioni, per versione del dataset e (colonna, n_boot, seed) più gli altri parametri
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _age_bootstrap(version, column, n_boot, seed, confidence, bandwidth, file_name, excluded_age):
+    data = data_cleaning.get_data_lazy(file_name, excluded_age).select("Age", column).collect()
+    return bootstrap_means(data, "Age", column, n_boot, seed, confidence, bandwidth, workers=WORKERS)
+
+
+# Intervalli di confidenza bootstrap della media di column per età (es. "Hours per day" o una condizione) e,
+# con bandwidth (in anni), la curva lisciata con la sua banda
+def get_age_bootstrap(column, n_boot=N_BOOT, seed=0, confidence=0.95, bandwidth=None,
+                      file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _age_bootstrap(version, column, n_boot, seed, confidence, bandwidth, file_name, excluded_age)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import threading
+from contextlib import nullcontext
+import altair as alt
+import polars as pl
+import streamlit as st
+from streamlit import dataframe_util
+
+# Se True le statistiche dei boxplot e le curve di densità vengono calcolate in Python e nei grafici finiscono
+# solo i punti riassuntivi; se False i dati grezzi vengono inviati al browser e le trasformazioni le fa Vega
+SERVER_SIDE_AGGREGATION = True
+SPEC_CACHE_ENTRIES = 256 # Specifiche Vega-Lite compilate tenute in memoria (grafico x versione del dataset x stato dei selettori)
+
+
+# Boxplot costruito a partire da statistiche già calcolate (vedi quantiles.box_stats_from_sketches):
+# baffi, scatola, mediana e outlier sono quattro layer sugli stessi campi usati da mark_boxplot di Vega-Lite
+def boxplot_from_stats(stats, outliers, x, y, x_title=None, y_title=None, sort=None, color="orange", size=14):
+    x_encoding = alt.X(f"{x}:N", title=x_title, sort=sort)
+    base = alt.Chart(stats).encode(x=x_encoding)
+
+    whiskers = base.mark_rule(color=color).encode(
+        y=alt.Y("lower:Q", title=y_title),
+        y2="upper:Q"
+    )
+    box = base.mark_bar(size=size, color=color).encode(
+        y="q1:Q",
+        y2="q3:Q",
+        tooltip=[
+            alt.Tooltip(f"{x}:N"),
+            alt.Tooltip("upper:Q", title="Baffo superiore"),
+            alt.Tooltip("q3:Q", title="Q3"),
+            alt.Tooltip("median:Q", title="Mediana"),
+            alt.Tooltip("q1:Q", title="Q1"),
+            alt.Tooltip("lower:Q", title="Baffo inferiore")
+        ]
+    )
+    median = base.mark_tick(color="white", size=size).encode(y="median:Q")
+    points = alt.Chart(outliers).mark_point(color=color).encode(
+        x=x_encoding,
+        y=f"{y}:Q",
+        tooltip=[alt.Tooltip(f"{x}:N"), alt.Tooltip(f"{y}:Q"), alt.Tooltip("count:Q", title="Numero di utenti")]
+    )
+    return alt.layer(whiskers, box, median, points)
+
+
+MAX_VOXELS = 2 ** 16 # Risoluzione massima della griglia di voxel per asse
+
+
+# Raggruppa i punti di frame (colonne x, y, z, count) in una griglia di voxels x voxels x voxels celle: per ogni cella
+# occupata resta un solo punto (il primo) con la somma dei conteggi e gli indici della cella (_voxel_0, _voxel_1, _voxel_2).
+# Le celle sono intervalli [i / voxels, (i + 1) / voxels) dell'asse normalizzato: raddoppiando voxels ogni cella
+# si divide in 8 celle figlie, con indici (i // 2) uguali a quelli della cella madre.
+def _voxel_grid(frame, x, y, z, voxels):
+    voxel_columns = []
+    for i, column in enumerate([x, y, z]):
+        low, high = frame[column].min(), frame[column].max()
+        span = (high - low) or 1
+        voxel_columns.append(
+            ((pl.col(column) - low) / span * voxels).floor().clip(upper_bound=voxels - 1).cast(pl.Int32).alias(f"_voxel_{i}")
+        )
+    return (
+        frame.with_columns(voxel_columns)
+        .group_by("_voxel_0", "_voxel_1", "_voxel_2", maintain_order=True)
+        .agg(pl.col(x, y, z).first(), pl.col("count").sum().cast(pl.UInt32))
+    )
+
+
+# Riduce i punti di frame a non più di budget con una griglia di voxel la cui risoluzione dipende dal budget:
+# si parte da circa budget ** (1/3) celle per asse (potenza di 2) e si raddoppia (o dimezza) finché si trovano
+# due griglie consecutive, una grossolana con al massimo budget celle occupate e una fine con più di budget.
+# Della griglia fine si tiene la prima cella figlia di ogni cella grossolana, più un campione casuale (riproducibile
+# con seed) delle altre fino ad arrivare a budget punti; i conteggi delle celle scartate vengono sommati al punto
+# tenuto nella loro cella grossolana, quindi la colonna count copre sempre tutte le righe di frame.
+# Se i punti sono già al massimo budget non viene fatto nulla.
+def _voxel_reduce(frame, x, y, z, budget, seed):
+    if frame.height <= budget:
+        return frame
+    if budget <= 0:
+        return frame.clear()
+
+    voxels = 1
+    while voxels ** 3 < budget:
+        voxels *= 2
+    coarse, fine = None, None
+    while coarse is None or fine is None:
+        grid = _voxel_grid(frame, x, y, z, voxels)
+        if grid.height > budget:
+            fine = grid
+            voxels //= 2 # Con una sola cella le celle occupate sono al massimo budget: il ciclo termina
+        else:
+            coarse = grid
+            if voxels >= MAX_VOXELS: # Troppi punti coincidenti: nessuna griglia supera il budget
+                break
+            voxels *= 2
+    if fine is None:
+        return coarse.select(x, y, z, "count")
+
+    parents = [(pl.col(f"_voxel_{i}") // 2).alias(f"_parent_{i}") for i in range(3)]
+    parent_columns = ["_parent_0", "_parent_1", "_parent_2"]
+    fine = fine.with_row_index("_id").with_columns(parents)
+    fine = fine.with_columns((pl.int_range(pl.len()).over(parent_columns) == 0).alias("_first"))
+    extra = fine.filter(~pl.col("_first")).sample(n=budget - coarse.height, seed=seed)["_id"]
+    fine = fine.with_columns((pl.col("_first") | pl.col("_id").is_in(extra.implode())).alias("_kept"))
+
+    merged = (
+        fine.filter(~pl.col("_kept"))
+        .group_by(parent_columns)
+        .agg(pl.col("count").sum().alias("_merged"))
+    )
+    return (
+        fine.filter(pl.col("_kept"))
+        .join(merged, on=parent_columns, how="left", nulls_equal=True)
+        .with_columns(
+            pl.when(pl.col("_first"))
+            .then(pl.col("count") + pl.col("_merged").fill_null(0))
+            .otherwise(pl.col("count"))
+            .cast(pl.UInt32)
+        )
+        .sort("_id")
+        .select(x, y, z, "count")
+    )
+
+
+# Riduce i punti di uno scatter 3D a un numero massimo (max_points) così il JSON della figura resta limitato.
+# - Le righe che soddisfano keep (es. gli outlier) hanno una quota riservata di keep_share * max_points punti (di più
+#   se le altre righe non usano tutto il resto): finché ci stanno vengono mantenute tutte, altrimenti vengono ridotte
+#   anche loro con la griglia di voxel.
+# - Le altre vengono raggruppate in una griglia di voxel con una risoluzione ricavata dal budget (vedi _voxel_reduce):
+#   per ogni cella resta un solo punto, con il numero di righe che rappresenta nella colonna "count".
+# Restituisce i punti da disegnare (mai più di max_points) e il numero di righe non disegnate come punto a sé.
+def downsample_3d(data, x, y, z, max_points=5000, keep=None, seed=0, keep_share=0.5):
+    data = data.select(x, y, z).with_columns(pl.lit(1, dtype=pl.UInt32).alias("count"))
+    if data.height <= max_points:
+        return data, 0
+
+    if keep is None:
+        keep = pl.lit(False)
+    keep = keep.fill_null(False)
+    kept = data.filter(keep)
+    rest = data.filter(~keep)
+    kept_budget = min(kept.height, max(int(max_points * keep_share), max_points - rest.height))
+    kept = _voxel_reduce(kept, x, y, z, kept_budget, seed)
+    rest = _voxel_reduce(rest, x, y, z, max_points - kept.height, seed)
+
+    sampled = pl.concat([kept, rest])
+    return sampled, data.height - sampled.height
+
+
+### CACHE DELLE SPECIFICHE VEGA-LITE
+
+# Le impostazioni di Altair (tema e trasformatore dei dati) sono globali: la compilazione avviene una alla volta
+_altair_lock = threading.Lock()
+
+
+# Codifica compatta delle colonne inviate al browser: decimali a 32 bit (circa 7 cifre significative, più che sufficienti
+# per un grafico), interi con il tipo più piccolo che contiene i valori e testi ripetuti come dizionario (ogni valore
+# distinto inviato una volta sola più un indice per riga, solo se i valori distinti sono pochi rispetto alle righe)
+DICTIONARY_RATIO = 4 # Testi codificati come dizionario se le righe sono almeno DICTIONARY_RATIO volte i valori distinti
+DICTIONARY_MIN_ROWS = 50 # Sotto questo numero di righe l'intestazione del dizionario costa più di quanto fa risparmiare
+INTEGER_TYPES = [(pl.Int8, 2**7), (pl.Int16, 2**15), (pl.Int32, 2**31)] # Tipi provati in ordine per le colonne intere (altrimenti restano a 64 bit)
+
+
+def compact_frame(frame):
+    columns = []
+    for name, dtype in frame.schema.items():
+        column = frame[name]
+        if dtype == pl.Float64:
+            columns.append(column.cast(pl.Float32))
+        elif dtype.is_integer() and column.null_count() < len(column):
+            low, high = column.min(), column.max()
+            fits = [int_type for int_type, limit in INTEGER_TYPES if -limit <= low and high < limit]
+            columns.append(column.cast(fits[0]) if fits else column)
+        elif dtype == pl.String and len(column) >= DICTIONARY_MIN_ROWS and column.n_unique() * DICTIONARY_RATIO <= len(column):
+            columns.append(column.cast(pl.Categorical))
+        else:
+            columns.append(column)
+    return pl.DataFrame(columns)
+
+
+# Trasformatore dei dati di Altair: invece di inserire le righe nella specifica (una lista di dizionari JSON) ogni
+# DataFrame viene compattato, serializzato in Arrow IPC e sostituito da un riferimento a un dataset con nome (hash del
+# contenuto), come fa st.altair_chart. Streamlit invia i dataset al browser così come sono, senza convertirli di nuovo.
+# Lo stesso DataFrame usato da più layer viene convertito una sola volta (names: id del DataFrame -> nome) e finisce
+# una sola volta in datasets, anche se è passato a ogni layer invece che al grafico combinato (vedi layer).
+def _named_dataset(data, datasets, names):
+    if id(data) in names:
+        return {"name": names[id(data)]}
+    payload = dataframe_util.convert_anything_to_arrow_bytes(compact_frame(data) if isinstance(data, pl.DataFrame) else data)
+    name = hashlib.sha1(payload).hexdigest()[:16]
+    datasets[name] = payload
+    names[id(data)] = name
+    return {"name": name}
+
+
+alt.data_transformers.register("mxmh_named_datasets", _named_dataset)
+
+
+# Compila un grafico Altair: restituisce la specifica Vega-Lite serializzata (JSON, senza dati) e i dataset con nome
+# (nome -> byte Arrow IPC). Il tema "none" è lo stesso usato da st.altair_chart, quindi la specifica è identica.
+def compile_spec(chart):
+    datasets = {}
+    with _altair_lock:
+        theme = alt.theme.enable("none") if alt.theme.active == "default" else nullcontext()
+        with theme, alt.data_transformers.enable("mxmh_named_datasets", datasets=datasets, names={}):
+            spec = chart.to_dict()
+    spec.pop("datasets", None)
+    return json.dumps(spec), datasets
+
+
+# Grafico a layer con i dati condivisi: data diventa il dataset del grafico combinato e i layer costruiti con
+# alt.Chart() senza dati lo ereditano (un solo riferimento nella specifica); i layer con dati propri li mantengono
+def layer(data, *layers, **kwargs):
+    return alt.layer(*layers, data=data, **kwargs)
+
+
+# Cache condivisa tra le sessioni: build (escluso dalla chiave) viene chiamata solo se la combinazione di grafico,
+# versione del dataset e stato dei selettori non è mai stata compilata
+@st.cache_resource(max_entries=SPEC_CACHE_ENTRIES, show_spinner=False)
+def _compiled_spec(chart_id, version, state, _build):
+    return compile_spec(_build())
+
+
+# Mostra un grafico Altair usando la specifica già compilata: build è una funzione senza argomenti che costruisce
+# il grafico, state contiene tutto ciò da cui il grafico dipende oltre ai dati (selettori, opzioni). Se nulla è
+# cambiato non vengono né ricostruiti gli oggetti di Altair né serializzati specifica e dati.
+def altair_chart(chart_id, build, version, state=(), **kwargs):
+    spec_json, datasets = _compiled_spec(chart_id, version, tuple(state), build)
+    spec = json.loads(spec_json) # Copia nuova ad ogni chiamata (Streamlit modifica la specifica che riceve)
+    spec["datasets"] = dict(datasets)
+    return st.vega_lite_chart(spec=spec, **kwargs)
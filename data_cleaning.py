@@ -1,15 +1,230 @@
+import glob
+import hashlib
+import os
+import shutil
 import polars as pl
+import streamlit as st
+import profiling
 
-def get_data():
-    file_name = "mxmh_survey_results.csv" # Nome del file
-    dtypes = { # Definisco alcuni i tipi di alcune variabili perchè altrimenti danno problemi
-        "Depression": pl.Float64,
-        "Anxiety": pl.Float64,
-        "OCD": pl.Float64,
-        "Insomnia": pl.Float64,
-        "Hours per day": pl.Float64,
-        "Age": pl.Int64
-    }
-    data = pl.read_csv(file_name, dtypes=dtypes) # Carica il dataset
-    data_filtered = data.filter(pl.col("Age") != 89) # Rimozione outlier
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) # Cartella del progetto (così il percorso non dipende dalla cartella di lavoro)
+FILE_NAME = os.environ.get("MXMH_FILE_NAME", "mxmh_survey_results.csv") # Nome del file (la variabile d'ambiente permette di usare un altro export)
+EXCLUDED_AGE = 89 # Età dell'outlier da rimuovere (utente di 89 anni con 24 ore di ascolto al giorno)
+CACHE_DIR = os.environ.get("MXMH_CACHE_DIR", os.path.join(BASE_DIR, ".mxmh_cache")) # Cartella con i file binari generati a partire dal csv
+
+PARTITION_BY = ["Primary streaming service", "Fav genre"] # Colonne di partizione del dataset partizionato
+PARTITION_ROW_GROUP_SIZE = 16_384 # Righe per row group nei file del dataset partizionato (ordinati per età)
+
+DTYPES = { # Definisco alcuni i tipi di alcune variabili perchè altrimenti danno problemi
+    "Depression": pl.Float64,
+    "Anxiety": pl.Float64,
+    "OCD": pl.Float64,
+    "Insomnia": pl.Float64,
+    "Hours per day": pl.Float64,
+    "Age": pl.Int64
+}
+
+
+# Restituisce il percorso assoluto del file (i percorsi relativi sono riferiti alla cartella del progetto)
+def get_data_path(file_name=FILE_NAME):
+    if os.path.isabs(file_name):
+        return file_name
+    return os.path.join(BASE_DIR, file_name)
+
+
+# Chiave che identifica una versione del dataset: percorso, data di modifica e dimensione del file
+# più i parametri di pulizia. Se il csv cambia, cambia anche la chiave.
+def get_data_key(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    path = get_data_path(file_name)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size, excluded_age)
+
+
+# Stringa corta che identifica la versione del dataset, usata nei nomi dei file di cache
+def get_data_version(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    return _version_from_key(get_data_key(file_name, excluded_age))
+
+
+def _version_from_key(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+# Prefisso dei file di cache di un dataset: nome e percorso del csv più l'età esclusa, senza data di modifica e dimensione.
+# Le versioni precedenti dello stesso dataset hanno lo stesso prefisso, quindi possono essere rimosse
+# senza toccare i file di altri dataset (un altro MXMH_FILE_NAME o un altro excluded_age) che usano la stessa cartella.
+def get_cache_prefix(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    return _cache_prefix_from_key((get_data_path(file_name), None, None, excluded_age))
+
+
+def _cache_prefix_from_key(key):
+    stem = os.path.splitext(os.path.basename(key[0]))[0]
+    return f"{stem}.{hashlib.sha1(key[0].encode()).hexdigest()[:8]}.{key[3]}"
+
+
+# Percorso del file Arrow IPC (sidecar) che contiene i dati già tipizzati e puliti per una versione del csv
+def get_sidecar_path(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    return _sidecar_path_from_key(get_data_key(file_name, excluded_age))
+
+
+def _sidecar_path_from_key(key):
+    return os.path.join(CACHE_DIR, f"{_cache_prefix_from_key(key)}.{_version_from_key(key)}.arrow")
+
+
+# Lettura del csv con i tipi corretti e rimozione dell'outlier
+def _read_csv_cleaned(path, excluded_age):
+    data = pl.read_csv(path, schema_overrides=DTYPES) # Carica il dataset
+    data_filtered = data.filter(pl.col("Age") != excluded_age) # Rimozione outlier
     return data_filtered
+
+
+# Stessa lettura di _read_csv_cleaned ma lazy: il csv viene letto a blocchi solo quando il piano viene eseguito
+def _scan_csv_cleaned(path, excluded_age):
+    return (
+        pl.scan_csv(path, schema_overrides=DTYPES)
+        .filter(pl.col("Age") != excluded_age) # Rimozione outlier
+    )
+
+
+# Scrive il sidecar per la versione indicata dalla chiave e rimuove quelli delle versioni precedenti dello stesso dataset.
+# Il file viene scritto senza compressione, altrimenti non potrebbe essere mappato in memoria senza copie,
+# e con un rename atomico, così più processi di Streamlit possono costruirlo in contemporanea senza leggere file a metà.
+# Se data è un piano lazy viene eseguito in streaming (sink): il csv non viene mai caricato tutto in memoria.
+@profiling.profiled("scrittura sidecar")
+def _write_sidecar(key, data):
+    sidecar = _sidecar_path_from_key(key)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    if isinstance(data, pl.LazyFrame):
+        data.sink_ipc(tmp_path, compression="uncompressed")
+    else:
+        data.write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, sidecar)
+
+    prefix = glob.escape(_cache_prefix_from_key(key))
+    for old in glob.glob(os.path.join(CACHE_DIR, f"{prefix}.*.arrow")):
+        if old != sidecar:
+            try:
+                os.remove(old)
+            except OSError: # Il file potrebbe essere ancora mappato da un altro processo (es. su Windows)
+                pass
+    return sidecar
+
+
+# Build step: genera (o rigenera) il sidecar a partire dal csv
+def build_sidecar(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    key = get_data_key(file_name, excluded_age)
+    return _write_sidecar(key, _scan_csv_cleaned(key[0], excluded_age))
+
+
+# Restituisce il percorso del sidecar, costruendolo se manca (primo caricamento o csv modificato).
+# Se la cartella di cache non è scrivibile restituisce None.
+def _ensure_sidecar(key):
+    sidecar = _sidecar_path_from_key(key)
+    if os.path.exists(sidecar):
+        return sidecar
+    try:
+        return _write_sidecar(key, _scan_csv_cleaned(key[0], key[3]))
+    except OSError:
+        return None
+
+
+# Caricamento vero e proprio, condiviso da tutte le sessioni del processo (cache_resource non copia il risultato).
+# I DataFrame di Polars non vengono modificati dalle pagine (ogni operazione ne crea uno nuovo),
+# quindi tutte le sessioni possono usare lo stesso oggetto.
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _load_data(path, mtime_ns, size, excluded_age):
+    key = (path, mtime_ns, size, excluded_age)
+    sidecar = _ensure_sidecar(key)
+    if sidecar is None: # Cartella non scrivibile: si usano direttamente i dati letti dal csv
+        return _read_csv_cleaned(path, excluded_age)
+    # Lettura zero-copy: i buffer delle colonne puntano al file mappato in memoria,
+    # quindi i processi che leggono lo stesso sidecar condividono le stesse pagine di memoria
+    return pl.read_ipc(sidecar, memory_map=True)
+
+
+@profiling.profiled()
+def get_data(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    # La chiave viene ricalcolata ad ogni chiamata (solo un os.stat): se il file cambia la cache viene invalidata
+    return _load_data(*get_data_key(file_name, excluded_age))
+
+
+# Versione lazy di get_data: restituisce un piano (LazyFrame) che legge il sidecar (o il csv) solo alla collect.
+# In questo modo vengono lette solo le colonne usate dalle pagine e i filtri vengono applicati durante la lettura.
+@profiling.profiled()
+def get_data_lazy(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE):
+    key = get_data_key(file_name, excluded_age)
+    sidecar = _ensure_sidecar(key)
+    if sidecar is None:
+        return _scan_csv_cleaned(key[0], excluded_age)
+    return pl.scan_ipc(sidecar, memory_map=True) # Il sidecar contiene già i dati puliti
+
+
+# Cartella del dataset partizionato (layout Hive: <colonna>=<valore>/.../*.parquet) per una versione del csv
+# e un insieme di colonne di partizione
+def _partitioned_path_from_key(key, partition_by):
+    return os.path.join(
+        CACHE_DIR, f"{_partitioned_prefix(key, partition_by)}.{_version_from_key((*key, *partition_by))}.parquet"
+    )
+
+
+# Prefisso delle cartelle partizionate: come quello del sidecar più le colonne di partizione
+def _partitioned_prefix(key, partition_by):
+    return f"{_cache_prefix_from_key(key)}.{_version_from_key(tuple(partition_by))[:8]}"
+
+
+# Scrive il dataset partizionato: una cartella per ogni combinazione dei valori delle colonne di partizione e, dentro,
+# file Parquet ordinati per età con statistiche min/max per row group. Come per il sidecar la cartella viene
+# scritta con un nome temporaneo e poi rinominata, e quelle delle versioni precedenti (stesso dataset e stesse
+# colonne di partizione) vengono rimosse.
+@profiling.profiled("scrittura dataset partizionato")
+def _write_partitioned(key, partition_by):
+    folder = _partitioned_path_from_key(key, partition_by)
+    tmp_folder = f"{folder}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    data = _scan_csv_cleaned(key[0], key[3]).sort([*partition_by, "Age"]).collect()
+    data.write_parquet(
+        tmp_folder,
+        partition_by=list(partition_by),
+        row_group_size=PARTITION_ROW_GROUP_SIZE,
+        statistics=True # Min/max per row group: i filtri sull'età saltano i row group fuori intervallo
+    )
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError: # Un altro processo ha già scritto la stessa versione
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    prefix = glob.escape(_partitioned_prefix(key, partition_by))
+    for old in glob.glob(os.path.join(CACHE_DIR, f"{prefix}.*.parquet")):
+        if old != folder:
+            shutil.rmtree(old, ignore_errors=True)
+    return folder
+
+
+# Build step del dataset partizionato (restituisce la cartella)
+def build_partitioned(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE, partition_by=PARTITION_BY):
+    return _write_partitioned(get_data_key(file_name, excluded_age), tuple(partition_by))
+
+
+# Piano lazy sul dataset partizionato, costruito se manca. I filtri sulle colonne di partizione (es. un genere o una
+# piattaforma) leggono solo le cartelle corrispondenti, quelli sull'età (es. Age <= 70) solo i row group il cui
+# intervallo [min, max] li soddisfa. Il risultato ha le stesse colonne, nello stesso ordine, di get_data_lazy;
+# se la cartella di cache non è scrivibile si ripiega su get_data_lazy.
+@profiling.profiled()
+def get_data_partitioned(file_name=FILE_NAME, excluded_age=EXCLUDED_AGE, partition_by=PARTITION_BY):
+    key = get_data_key(file_name, excluded_age)
+    partition_by = tuple(partition_by)
+    folder = _partitioned_path_from_key(key, partition_by)
+    if not os.path.isdir(folder):
+        try:
+            _write_partitioned(key, partition_by)
+        except OSError:
+            return get_data_lazy(file_name, excluded_age)
+    return pl.scan_parquet(
+        folder,
+        hive_partitioning=True,
+        hive_schema={col: pl.String for col in partition_by} # I valori delle partizioni restano stringhe
+    )
+
+
+if __name__ == "__main__":
+    print(f"Sidecar scritto in {build_sidecar()}")
+    print(f"Dataset partizionato scritto in {build_partitioned()}")
@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import threading
+import polars as pl
+import streamlit as st
+import data_cleaning
+import moments
+
+TAIL_CHECK_BYTES = 4096 # Byte prima dell'ultima posizione letta usati per verificare che il file non sia stato riscritto
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S" # Formato della colonna Timestamp (es. 8/27/2022 19:29:02)
+
+# Colonne delle statistiche sufficienti (somme, quadrati e prodotti incrociati) usate dai modelli di regressione
+MOMENT_COLUMNS = ["Age", "Hours per day", "Depression", "Anxiety", "OCD", "Insomnia"]
+
+# Somme per gruppo mantenute aggiornate: nome -> (colonne di raggruppamento, colonne numeriche)
+GROUPED_SUMS = {
+    "age": (["Age"], ["Hours per day", "Anxiety", "Depression", "Insomnia", "OCD"])
+}
+
+
+# Stato dell'ingestione incrementale di un file csv a cui vengono aggiunte nuove risposte in fondo.
+# Ad ogni refresh vengono lette e processate solo le righe successive all'ultima posizione letta (offset in byte)
+# e vengono aggiornate le statistiche (somme, quadrati, prodotti incrociati e somme per gruppo): il costo dipende
+# dal numero di nuove risposte e non dalla dimensione del file.
+# Se il file viene riscritto (es. un nuovo export completo) la parte già letta non coincide più: in quel caso
+# vengono aggiunte solo le righe con Timestamp successivo all'ultimo già visto (le risposte già raccolte non cambiano).
+class IncrementalSurvey:
+    def __init__(self, path, excluded_age=data_cleaning.EXCLUDED_AGE):
+        self.path = path
+        self.excluded_age = excluded_age
+        self._lock = threading.Lock() # Lo stato è condiviso tra le sessioni di Streamlit
+        self._reset()
+
+    def _reset(self):
+        self.header = None # Prima riga del csv (serve per leggere i blocchi di righe nuove)
+        self.schema = None # Schema del csv completo, riusato per i blocchi di righe nuove
+        self.offset = 0 # Byte già letti (sempre alla fine di una riga)
+        self.pending = None # Ultima riga senza a capo (contata in modo provvisorio)
+        self.pending_bytes = 0
+        self.mtime_ns = None
+        self.tail_hash = None
+        self.rows = 0
+        self.last_timestamp = None
+        self.moments = moments.MomentAccumulator(MOMENT_COLUMNS)
+        self.grouped = {name: None for name in GROUPED_SUMS}
+
+    # Legge le righe nuove e aggiorna le statistiche; restituisce il numero di righe aggiunte
+    def refresh(self):
+        with self._lock:
+            stat = os.stat(self.path)
+            if self.header is not None and stat.st_size == self.offset + self.pending_bytes and stat.st_mtime_ns == self.mtime_ns:
+                return 0 # Nessuna modifica
+            with open(self.path, "rb") as file:
+                if self.header is None:
+                    added = self._ingest_full(file.read())
+                elif stat.st_size < self.offset or self._tail_digest(file) != self.tail_hash:
+                    added = self._ingest_rewritten(file.read())
+                else:
+                    file.seek(self.offset)
+                    added = self._ingest_chunk(file.read())
+                self.tail_hash = self._tail_digest(file)
+            self.mtime_ns = stat.st_mtime_ns
+            return added
+
+    def _tail_digest(self, file):
+        start = max(self.offset - TAIL_CHECK_BYTES, 0)
+        file.seek(start)
+        return hashlib.sha1(file.read(self.offset - start)).hexdigest()
+
+    # Divide i byte letti nelle righe complete (terminate da un a capo), che aggiornano le statistiche, e
+    # nell'eventuale ultima riga senza a capo. Quest'ultima viene contata solo in modo provvisorio (pending):
+    # potrebbe essere ancora in scrittura, quindi al prossimo refresh viene riletta insieme alle righe nuove.
+    def _split(self, content):
+        end = content.rfind(b"\n") + 1
+        tail = content[end:]
+        self.pending = self._clean(self._parse(tail)) if tail.strip() else None
+        self.pending_bytes = len(tail)
+        return content[:end]
+
+    def _parse(self, body):
+        return pl.read_csv(io.BytesIO(self.header + body), schema=self.schema)
+
+    # Primo caricamento: tutto il file
+    def _ingest_full(self, content):
+        self.header = content[:content.find(b"\n") + 1]
+        frame = pl.read_csv(io.BytesIO(content), schema_overrides=data_cleaning.DTYPES) # Lo schema viene dedotto dal file completo
+        self.schema = frame.schema
+        body = self._split(content[len(self.header):])
+        self.offset = len(self.header) + len(body)
+        if self.pending_bytes and content[self.offset:].strip():
+            frame = frame.head(frame.height - 1) # L'ultima riga senza a capo è già in self.pending
+        return self._update(frame) + (self.pending.height if self.pending is not None else 0)
+
+    # Righe aggiunte in fondo al file dall'ultimo refresh (compresa l'eventuale riga provvisoria, che viene riletta)
+    def _ingest_chunk(self, chunk):
+        previous_pending = self.pending.height if self.pending is not None else 0
+        body = self._split(chunk)
+        self.offset += len(body)
+        added = self._update(self._parse(body)) if body else 0
+        return added + (self.pending.height if self.pending is not None else 0) - previous_pending
+
+    # File riscritto: si aggiungono solo le risposte più recenti dell'ultimo Timestamp visto
+    def _ingest_rewritten(self, content):
+        if self.last_timestamp is None:
+            self._reset()
+            return self._ingest_full(content)
+        previous_pending = self.pending.height if self.pending is not None else 0
+        last_timestamp = self.last_timestamp
+        body = self._split(content[len(self.header):])
+        self.offset = len(self.header) + len(body)
+        if self.pending is not None:
+            self.pending = self.pending.filter(self._timestamp_expr() > last_timestamp)
+        frame = self._parse(body).filter(self._timestamp_expr() > last_timestamp)
+        return self._update(frame) + (self.pending.height if self.pending is not None else 0) - previous_pending
+
+    def _timestamp_expr(self):
+        return pl.col("Timestamp").str.strptime(pl.Datetime, TIMESTAMP_FORMAT, strict=False)
+
+    def _clean(self, frame):
+        return frame.filter(pl.col("Age") != self.excluded_age) # Rimozione outlier (stessa pulizia di data_cleaning)
+
+    # Aggiorna le statistiche con le righe complete indicate
+    def _update(self, frame):
+        frame = self._clean(frame)
+        if frame.height == 0:
+            return 0
+        self._accumulate(frame, self.moments, self.grouped)
+        latest = frame.select(self._timestamp_expr().max()).item()
+        if latest is not None and (self.last_timestamp is None or latest > self.last_timestamp):
+            self.last_timestamp = latest
+        self.rows += frame.height
+        return frame.height
+
+    def _accumulate(self, frame, survey_moments, grouped):
+        survey_moments.update(frame)
+        for name, (by, values) in GROUPED_SUMS.items():
+            grouped[name] = moments.merge_grouped_sums(grouped[name], moments.grouped_sums(frame, by, values), by)
+
+    # Copia dello stato attuale, compresa l'eventuale riga provvisoria (le statistiche possono essere usate senza tenere il lock)
+    def snapshot(self):
+        with self._lock:
+            survey_moments = self.moments.copy()
+            grouped = dict(self.grouped)
+            rows = self.rows
+            if self.pending is not None and self.pending.height > 0:
+                self._accumulate(self.pending, survey_moments, grouped)
+                rows += self.pending.height
+            return {
+                "rows": rows,
+                "last_timestamp": self.last_timestamp,
+                "moments": survey_moments,
+                "grouped": grouped
+            }
+
+
+# Un solo stato per file e parametri di pulizia, condiviso da tutte le sessioni del processo
+@st.cache_resource(show_spinner=False)
+def _survey_state(path, excluded_age):
+    return IncrementalSurvey(path, excluded_age)
+
+
+# Aggiorna lo stato con le eventuali nuove risposte e ne restituisce una copia
+def get_survey_state(file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    state = _survey_state(data_cleaning.get_data_path(file_name), excluded_age)
+    state.refresh()
+    return state.snapshot()
@@ -0,0 +1,169 @@
+import math
+import numpy as np
+import polars as pl
+import streamlit as st
+import data_cleaning
+import quantiles
+
+DIRECT_MAX_ROWS = 20_000 # Oltre questo numero di righe la KDE viene calcolata con binning lineare + FFT
+CHUNK_ROWS = 4096 # Righe elaborate per volta nel calcolo diretto (limita la memoria usata dal broadcasting)
+FFT_BINS = 2048 # Numero di bin della griglia usata dal metodo FFT
+
+
+# Larghezza di banda con la regola di Scott, la stessa stima usata da Vega in transform_density.
+# Calcolata per tutte le colonne insieme: values è una matrice (righe x colonne) con NaN al posto dei valori mancanti.
+def scott_bandwidth(values):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    n = np.sum(~np.isnan(values), axis=0)
+    q1, q3 = np.nanquantile(values, [0.25, 0.75], axis=0)
+    sd = np.nanstd(values, axis=0, ddof=1)
+    spread = np.minimum(sd, (q3 - q1) / 1.34)
+    spread = np.where(spread > 0, spread, sd) # Stesse alternative usate da Vega quando lo scarto interquartile è nullo
+    spread = np.where(spread > 0, spread, np.abs(q1))
+    spread = np.where(spread > 0, spread, 1.0)
+    return 1.06 * spread * n.astype(float) ** -0.2
+
+
+# Griglia uniforme su cui vengono valutate le densità (arrotondata per evitare valori come 0.30000000000000004)
+def _grid(extent, steps):
+    return np.round(np.linspace(extent[0], extent[1], steps), 10)
+
+
+# Regola di Scott a partire da valori distinti e conteggi (dà lo stesso risultato di scott_bandwidth sui dati completi)
+def histogram_scott_bandwidth(values, counts):
+    n = counts.sum()
+    mean = np.sum(values * counts) / n
+    sd = math.sqrt(np.sum(counts * (values - mean) ** 2) / (n - 1)) if n > 1 else 0
+    q1, q3 = quantiles.histogram_quantile(values, counts, [0.25, 0.75])
+    spread = min(sd, (q3 - q1) / 1.34) or sd or abs(q1) or 1
+    return 1.06 * spread * n ** -0.2
+
+
+# KDE diretta: somma dei kernel gaussiani con broadcasting (griglia x righe x colonne), a blocchi di righe.
+# weights (opzionale, stessa forma di values) permette di passare valori distinti con il numero di ripetizioni.
+def _direct_kde(values, grid, bandwidth, weights=None):
+    density = np.zeros((len(grid), values.shape[1]))
+    for start in range(0, values.shape[0], CHUNK_ROWS):
+        chunk = values[start:start + CHUNK_ROWS]
+        z = (grid[:, None, None] - chunk[None, :, :]) / bandwidth[None, None, :]
+        kernel = np.exp(-0.5 * z ** 2)
+        if weights is not None:
+            kernel = kernel * weights[None, start:start + CHUNK_ROWS, :]
+        density += np.nansum(kernel, axis=1) # I NaN (valori mancanti) non contribuiscono
+    return density
+
+
+# KDE approssimata: i valori vengono distribuiti su una griglia fine con binning lineare e la somma dei kernel
+# diventa una convoluzione, calcolata con la FFT per tutte le colonne insieme. Il costo dipende dal numero
+# di bin e non dal numero di righe.
+def _binned_kde(values, grid, bandwidth):
+    k = values.shape[1]
+    lo = min(grid[0], np.nanmin(values)) - 4 * bandwidth.max() # La griglia fine copre tutti i dati e le code dei kernel
+    hi = max(grid[-1], np.nanmax(values)) + 4 * bandwidth.max()
+    delta = (hi - lo) / (FFT_BINS - 1)
+
+    # Binning lineare di tutte le colonne con un solo bincount (ogni colonna ha il suo blocco di bin)
+    position = (values - lo) / delta
+    valid = ~np.isnan(position)
+    left = np.floor(np.where(valid, position, 0)).astype(np.int64)
+    left = np.clip(left, 0, FFT_BINS - 2)
+    weight_right = np.where(valid, position - left, 0)
+    weight_left = np.where(valid, 1 - weight_right, 0)
+    offset = np.arange(k) * FFT_BINS
+    counts = (
+        np.bincount((left + offset).ravel(), weights=weight_left.ravel(), minlength=k * FFT_BINS)
+        + np.bincount((left + 1 + offset).ravel(), weights=weight_right.ravel(), minlength=k * FFT_BINS)
+    ).reshape(k, FFT_BINS)
+
+    # Convoluzione con il kernel gaussiano di ogni colonna (padding per evitare l'effetto circolare della FFT)
+    size = 2 * FFT_BINS
+    distances = np.arange(size, dtype=float)
+    distances = np.minimum(distances, size - distances) * delta
+    kernels = np.exp(-0.5 * (distances[None, :] / bandwidth[:, None]) ** 2)
+    smoothed = np.fft.irfft(np.fft.rfft(counts, n=size, axis=1) * np.fft.rfft(kernels, axis=1), n=size, axis=1)[:, :FFT_BINS]
+
+    # Interpolazione dalla griglia fine alla griglia richiesta
+    fine_grid = lo + np.arange(FFT_BINS) * delta
+    return np.column_stack([np.interp(grid, fine_grid, smoothed[j]) for j in range(k)])
+
+
+# KDE gaussiana di più colonne in un colpo solo. Restituisce una tabella long (group_name, value_name, density)
+# con tutte le colonne valutate sulla stessa griglia, così le curve possono essere anche ruotate in formato wide.
+# - extent: estremi della griglia (se None va dal minimo al massimo dei dati, come in Vega)
+# - bandwidth: None per la regola di Scott (per colonna) oppure un valore unico
+# - method: "direct", "binned" (FFT) oppure "auto" (sceglie in base al numero di righe)
+def kde_table(data, columns, extent=None, steps=200, bandwidth=None, method="auto",
+              group_name="Condition", value_name="Value"):
+    values = data.select(pl.col(columns).cast(pl.Float64)).to_numpy() # NaN al posto dei valori mancanti
+    n = np.sum(~np.isnan(values), axis=0)
+    if extent is None:
+        extent = (np.nanmin(values), np.nanmax(values))
+    grid = _grid(extent, steps)
+    if bandwidth is None:
+        bandwidth = scott_bandwidth(values)
+    else:
+        bandwidth = np.full(len(columns), float(bandwidth))
+
+    if method == "auto":
+        method = "direct" if values.shape[0] <= DIRECT_MAX_ROWS else "binned"
+    kernel_sums = _direct_kde(values, grid, bandwidth) if method == "direct" else _binned_kde(values, grid, bandwidth)
+    density = kernel_sums / (n * bandwidth * math.sqrt(2 * math.pi))
+
+    return pl.DataFrame({
+        group_name: np.repeat(columns, steps),
+        value_name: np.tile(grid, len(columns)),
+        "density": density.T.ravel()
+    })
+
+
+# Stessa KDE di kde_table (metodo diretto) calcolata da una tabella di conteggi in formato long
+# (group_name, value_name, count_name) con i valori distinti di ogni gruppo: utile quando i dati non stanno in memoria
+# ma i valori distinti sono pochi (es. livelli da 0 a 10), perché il costo dipende solo dai valori distinti.
+def kde_table_from_counts(counts, columns, extent=None, steps=200, bandwidth=None,
+                          group_name="Condition", value_name="Value", count_name="count"):
+    counts = counts.filter(pl.col(value_name).is_not_null())
+    per_group = []
+    for column in columns:
+        part = counts.filter(pl.col(group_name) == column).sort(value_name)
+        per_group.append((part[value_name].cast(pl.Float64).to_numpy(), part[count_name].cast(pl.Float64).to_numpy()))
+    size = max(len(group_values) for group_values, _ in per_group)
+
+    # Matrici (valori distinti x colonne) con NaN e peso 0 come riempimento
+    values = np.full((size, len(columns)), np.nan)
+    weights = np.zeros((size, len(columns)))
+    for j, (group_values, group_counts) in enumerate(per_group):
+        values[:len(group_values), j] = group_values
+        weights[:len(group_counts), j] = group_counts
+
+    if extent is None:
+        extent = (np.nanmin(values), np.nanmax(values))
+    grid = _grid(extent, steps)
+    if bandwidth is None:
+        bandwidth = np.array([histogram_scott_bandwidth(v, c) for v, c in per_group])
+    else:
+        bandwidth = np.full(len(columns), float(bandwidth))
+    n = weights.sum(axis=0)
+    density = _direct_kde(values, grid, bandwidth, weights) / (n * bandwidth * math.sqrt(2 * math.pi))
+
+    return pl.DataFrame({
+        group_name: np.repeat(columns, steps),
+        value_name: np.tile(grid, len(columns)),
+        "density": density.T.ravel()
+    })
+
+
+# Cache condivisa tra le sessioni: una tabella per ogni (versione del dataset, condizioni, banda, estensione, griglia)
+@st.cache_resource(max_entries=16, show_spinner=False)
+def _condition_densities(version, conditions, bandwidth, extent, steps, file_name, excluded_age):
+    data = data_cleaning.get_data_lazy(file_name, excluded_age).select(conditions).collect() # Legge solo le colonne delle condizioni
+    return kde_table(data, list(conditions), extent=extent, steps=steps, bandwidth=bandwidth)
+
+
+# Densità delle condizioni psichiche, calcolate una sola volta per ogni combinazione di parametri
+def condition_densities(conditions, bandwidth=None, extent=None, steps=200,
+                        file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    extent = tuple(extent) if extent is not None else None
+    return _condition_densities(version, tuple(conditions), bandwidth, extent, steps, file_name, excluded_age)
@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+
+CHUNK_ROWS = 100_000 # Righe elaborate per volta da pairwise_moments
+
+
+# Accumulatore delle statistiche sufficienti di un insieme di colonne numeriche: numero di righe, somme,
+# somme dei quadrati e prodotti incrociati, raccolti nella matrice Z'Z con Z = [1, colonne].
+# Vengono considerate solo le righe complete (senza valori nulli in nessuna delle colonne).
+# Due accumulatori sulle stesse colonne si possono sommare (merge), quindi le statistiche si aggiornano
+# con le sole righe nuove o si calcolano a blocchi.
+class MomentAccumulator:
+    def __init__(self, columns):
+        self.columns = list(columns)
+        k = len(self.columns) + 1
+        self.zz = np.zeros((k, k)) # Z'Z: zz[0, 0] = n, zz[0, 1:] = somme, zz[1:, 1:] = prodotti incrociati
+        self.minimum = np.full(k - 1, np.inf) # Minimi e massimi (servono per esempio per le griglie dei grafici)
+        self.maximum = np.full(k - 1, -np.inf)
+
+    def update(self, frame):
+        values = frame.select(pl.col(self.columns).cast(pl.Float64)).drop_nulls().to_numpy()
+        if len(values) == 0:
+            return self
+        z = np.column_stack([np.ones(len(values)), values])
+        self.zz += z.T @ z
+        self.minimum = np.minimum(self.minimum, values.min(axis=0))
+        self.maximum = np.maximum(self.maximum, values.max(axis=0))
+        return self
+
+    def merge(self, other):
+        self.zz += other.zz
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        return self
+
+    def copy(self):
+        result = MomentAccumulator(self.columns)
+        return result.merge(self)
+
+    @property
+    def n(self):
+        return int(self.zz[0, 0])
+
+    def mean(self):
+        return self.zz[0, 1:] / self.zz[0, 0]
+
+    def covariance(self, ddof=1):
+        n = self.zz[0, 0]
+        mean = self.mean()
+        return (self.zz[1:, 1:] - n * np.outer(mean, mean)) / (n - ddof)
+
+    def correlation(self):
+        cov = self.covariance()
+        sd = np.sqrt(np.diag(cov))
+        return cov / np.outer(sd, sd)
+
+    # Sottomatrice Z'Z per le colonne indicate (la riga/colonna 0 resta quella dell'intercetta)
+    def cross_products(self, columns):
+        idx = [0] + [self.columns.index(column) + 1 for column in columns]
+        return self.zz[np.ix_(idx, idx)]
+
+
+# Accumulatore dei momenti a coppie per la correlazione di Pearson: per ogni coppia di colonne (i, j) vengono usate
+# solo le righe in cui entrambe sono non nulle (gestione dei valori mancanti "pairwise", come pandas.DataFrame.corr).
+# Per ogni coppia tiene il numero di righe, le medie, le somme dei quadrati degli scarti e il co-momento (somma dei
+# prodotti degli scarti), tutte matrici k x k. I blocchi vengono uniti con le formule di Chan/Welford, che aggiornano
+# gli scarti dalla media invece delle somme grezze: niente cancellazione numerica anche con valori grandi (es. BPM).
+class PairwiseMoments:
+    def __init__(self, columns):
+        self.columns = list(columns)
+        k = len(self.columns)
+        self.count = np.zeros((k, k)) # count[i, j]: righe con i e j entrambe non nulle
+        self.mean = np.zeros((k, k)) # mean[i, j]: media di i su quelle righe
+        self.m2 = np.zeros((k, k)) # m2[i, j]: somma dei quadrati degli scarti di i su quelle righe
+        self.comoment = np.zeros((k, k)) # comoment[i, j]: somma dei prodotti degli scarti di i e j
+
+    def update(self, frame):
+        values = frame.select(pl.col(self.columns).cast(pl.Float64)).to_numpy() # NaN al posto dei valori mancanti
+        return self.merge(self._from_values(values))
+
+    # Momenti di un blocco: i valori vengono prima traslati della media della colonna nel blocco, poi tutte le coppie
+    # vengono calcolate insieme con prodotti matriciali sulla maschera dei valori validi
+    def _from_values(self, values):
+        block = PairwiseMoments(self.columns)
+        valid = ~np.isnan(values)
+        mask = valid.astype(float)
+        valid_counts = valid.sum(axis=0)
+        shift = np.divide(np.where(valid, values, 0).sum(axis=0), valid_counts,
+                          out=np.zeros(len(self.columns)), where=valid_counts > 0)
+        centered = np.where(valid, values - shift, 0)
+
+        block.count = mask.T @ mask
+        sums = centered.T @ mask # sums[i, j]: somma di i (traslata) sulle righe valide per i e j
+        centered_mean = np.divide(sums, block.count, out=np.zeros_like(sums), where=block.count > 0)
+        block.mean = centered_mean + shift[:, None]
+        block.m2 = (centered ** 2).T @ mask - sums * centered_mean
+        block.comoment = centered.T @ centered - sums * centered_mean.T
+        return block
+
+    def merge(self, other):
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        weight = np.divide(other.count, count, out=np.zeros_like(count), where=count > 0)
+        factor = self.count * weight # n_a * n_b / n
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + other.m2 + delta ** 2 * factor
+        self.comoment = self.comoment + other.comoment + delta * delta.T * factor
+        self.count = count
+        return self
+
+    def copy(self):
+        result = PairwiseMoments(self.columns)
+        return result.merge(self)
+
+    def covariance(self, ddof=1):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.count > ddof, self.comoment / (self.count - ddof), np.nan)
+
+    # Matrice di correlazione di Pearson (NaN per le coppie senza almeno due righe o con varianza nulla)
+    def correlation(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = self.comoment / np.sqrt(self.m2 * self.m2.T)
+        return np.where(self.count > 1, np.clip(correlation, -1, 1), np.nan)
+
+
+# Momenti a coppie di un DataFrame calcolati a blocchi di chunk_rows righe; con workers > 1 i blocchi vengono
+# elaborati in parallelo (i prodotti matriciali di NumPy rilasciano il GIL) e poi uniti
+def pairwise_moments(frame, columns, chunk_rows=CHUNK_ROWS, workers=1):
+    columns = list(columns)
+    chunks = frame.select(columns).iter_slices(chunk_rows)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            blocks = list(pool.map(lambda chunk: PairwiseMoments(columns).update(chunk), chunks))
+    else:
+        blocks = (PairwiseMoments(columns).update(chunk) for chunk in chunks)
+    result = PairwiseMoments(columns)
+    for block in blocks:
+        result.merge(block)
+    return result
+
+
+# Somme per gruppo (numero di righe, numero di valori non nulli, somma e somma dei quadrati di ogni colonna):
+# sono additive, quindi le tabelle calcolate su blocchi diversi di righe si uniscono con merge_grouped_sums
+def grouped_sums(frame, by, values=()):
+    aggregations = [pl.len().alias("count")]
+    for value in values:
+        aggregations += [
+            pl.col(value).count().alias(f"{value}_count"),
+            pl.col(value).sum().alias(f"{value}_sum"),
+            (pl.col(value).cast(pl.Float64) ** 2).sum().alias(f"{value}_sumsq")
+        ]
+    return frame.group_by(by).agg(aggregations)
+
+
+def merge_grouped_sums(old, new, by):
+    if old is None:
+        return new
+    return pl.concat([old, new], how="vertical_relaxed").group_by(by).agg(pl.all().sum())
+
+
+# Media e varianza per gruppo a partire dalle somme di grouped_sums
+def grouped_mean_variance(sums, by, value):
+    n = pl.col(f"{value}_count")
+    mean = pl.col(f"{value}_sum") / n
+    return sums.select(
+        *([by] if isinstance(by, str) else by),
+        n.alias("count"),
+        mean.alias("mean"),
+        ((pl.col(f"{value}_sumsq") - n * mean ** 2) / (n - 1)).alias("variance")
+    )
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+# Regressione lineare (minimi quadrati ordinari) con più variabili risposta stimate insieme, a partire dalle statistiche
+# sufficienti (equazioni normali): zz è la matrice Z'Z con Z = [1, variabili esplicative, variabili risposta]
+# (vedi moments.MomentAccumulator.cross_products) e p è il numero di variabili esplicative. Permette di aggiornare
+# i modelli con le sole righe nuove, senza rileggere i dati. Il modello include l'intercetta. Restituisce un dizionario con:
+# - "intercept": intercette (k), "coef": coefficienti (p x k)
+# - "r2": coefficienti di determinazione (k)
+# - "intercept_se", "coef_se": errori standard delle stime (k e p x k)
+# - "n": numero di osservazioni
+def fit_ols_from_moments(zz, p):
+    n = zz[0, 0]
+    xtx = zz[:p + 1, :p + 1] # X'X (con l'intercetta)
+    xty = zz[:p + 1, p + 1:] # X'Y
+    yty = np.diag(zz[p + 1:, p + 1:]) # Somme dei quadrati delle risposte
+
+    xtx_inv = np.linalg.pinv(xtx)
+    beta = xtx_inv @ xty
+    sse = yty - np.sum(beta * xty, axis=0) # SSE = Y'Y - beta'X'Y
+    sst = yty - zz[0, p + 1:] ** 2 / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = np.where(sst > 0, 1 - sse / sst, np.nan)
+
+    dof = n - np.linalg.matrix_rank(xtx)
+    sigma2 = np.maximum(sse, 0) / dof if dof > 0 else np.full(len(sse), np.nan)
+    se = np.sqrt(np.diag(xtx_inv)[:, None] * sigma2[None, :])
+
+    return {
+        "intercept": beta[0],
+        "coef": beta[1:],
+        "r2": r2,
+        "intercept_se": se[0],
+        "coef_se": se[1:],
+        "n": int(n)
+    }
+
+
+# Valori predetti dal modello per le righe di X (una colonna per variabile risposta)
+def predict(fit, X):
+    return fit["intercept"] + np.asarray(X, dtype=float) @ fit["coef"]
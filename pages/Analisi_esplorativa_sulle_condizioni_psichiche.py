@@ -1,8 +1,14 @@
 import altair as alt
 import polars as pl
 import streamlit as st
-import numpy as np
+import aggregates
+import bootstrap
+import charts
 import data_cleaning
+import ingestion
+import kde
+import moments
+import profiling
 
 # Imposta il nome che viene fuori nel browser con emoji
 st.set_page_config(
@@ -10,8 +16,13 @@ st.set_page_config(
     page_icon=":brain:"
 )
 
-# Importo i dati con la funzione definita in data_cleaning.py (get_data)
-data = data_cleaning.get_data()
+# Misura dei blocchi della pagina ad ogni riesecuzione (pannello "Profiling" nella barra laterale, se attivo)
+profiling.start_run("Condizioni psichiche")
+
+# Importo i dati con la funzione definita in data_cleaning.py (get_data_lazy): è un piano lazy, 
+# i dati vengono letti solo quando i piani costruiti sotto vengono eseguiti
+data = data_cleaning.get_data_lazy()
+version = data_cleaning.get_data_version() # Versione del dataset: con lo stato dei selettori identifica le specifiche dei grafici già compilate
 
 st.markdown("""
 # Analisi esplorativa sulle condizioni psichiche
@@ -28,21 +39,37 @@ In questa sezione verranno studiati dati relativi alle **condizioni psichiche**.
 
 
 
-### DENSITÀ PER LE CONDIZIONI 
-
-# Titolo messo prima altrimenti uscirebbe prima il select per le condizioni
-st.write("### Curve di Densità delle Condizioni Psichiche")
+### PREPARAZIONE DEI DATI
 
 # Variabili delle condizioni psichiche
 psych_conditions = ["Anxiety", "Depression", "Insomnia", "OCD"]
-condition_dens_data = data.select(psych_conditions) # Seleziona solo le colonne delle condizioni
 
-# Trasforma i dati in formato long per Altair
-long_data = condition_dens_data.melt(
-    value_vars=psych_conditions,
-    variable_name="Condition", # Nome della variabile categoriale
-    value_name="Value" # Nome della variabile numerica
-).filter(pl.col("Value").is_not_null()) # Rimuove valori nulli
+# Trasforma i dati in formato long per Altair (vengono lette solo le colonne delle condizioni). Resta un piano lazy:
+# serve solo se le densità le calcola il browser (SERVER_SIDE_AGGREGATION = False) e viene eseguito in quel caso
+long_data = (
+    data.select(psych_conditions) # Seleziona solo le colonne delle condizioni
+    .unpivot(
+        on=psych_conditions,
+        variable_name="Condition", # Nome della variabile categoriale
+        value_name="Value" # Nome della variabile numerica
+    )
+    .filter(pl.col("Value").is_not_null()) # Rimuove valori nulli
+)
+
+# Densità delle quattro condizioni calcolate in Python una sola volta (KDE vettorizzata, vedi kde.py) sull'estensione
+# del violin plot [-3, 14] con passo 0.1: la stessa tabella alimenta curve, linea verticale, punti e violini
+if charts.SERVER_SIDE_AGGREGATION:
+    with profiling.block("densità KDE") as measure:
+        condition_densities = measure.set_rows(kde.condition_densities(psych_conditions, extent=(-3, 14), steps=171))
+
+
+
+
+
+### DENSITÀ PER LE CONDIZIONI 
+
+# Titolo messo prima altrimenti uscirebbe prima il select per le condizioni
+st.write("### Curve di Densità delle Condizioni Psichiche")
 
 # Seleziona le condizioni da visualizzare
 selected_conditions = st.multiselect(
@@ -52,110 +79,126 @@ selected_conditions = st.multiselect(
     key="condition_selector" # Chiave per Streamlit
 )
 
-# Filtra i dati in base alle condizioni selezionate
-filtered_long_data = long_data.filter(pl.col("Condition").is_in(selected_conditions))
-
 # Colori personalizzati per ogni condizione
 custom_colors = ['#1f77b4', # Blu per Anxiety
                  '#ff7f0e', # Arancione per Depression
                  '#2ca02c', # Verde per Insomnia
                  '#d62728'] # Rosso per OCD
 
-# Grafico delle curve di densità
-condition_dens = (
-    alt.Chart(filtered_long_data)
-    .transform_density(
-        'Value', # Variabile numerica da convertire in densità
-        as_=['Value', 'density'], # Output della densità
-        groupby=['Condition'] # Calcola la densità per ogni condizione
-    )
-    .mark_line(size=2) # Linea per rappresentare la densità
-    .encode(
-        alt.X('Value:Q', 
-            title="Livello delle Condizioni",
-            scale=alt.Scale(domain=[0, 10]) # Misurazioni delle condizioni da 0 a 10
-            ),  
-        alt.Y('density:Q', 
-            title="Densità", 
-            scale=alt.Scale(domain=[0, 0.25]) # Dato che le densità non superano il 0.25, per avere un buon impatto visivo
-            ),              
-        alt.Color(
-            'Condition:N', # Colore in base alla condizione
-            title="Condizione Psichica", # Titolo della legenda
-            scale=alt.Scale(domain=["Anxiety", "Depression", "Insomnia", "OCD"], range=custom_colors)  # Colori personalizzati
+# Curve di densità delle condizioni selezionate (costruite solo se la specifica non è già nella cache, vedi charts.altair_chart)
+def build_density_chart():
+    # Le curve e i punti usano gli stessi dati (density_source), inviati una sola volta per il grafico combinato
+    if charts.SERVER_SIDE_AGGREGATION:
+        # Nel grafico finiscono solo i punti delle curve (101 per condizione), indipendentemente dal numero di rispondenti
+        density_source = condition_densities.filter(
+            pl.col("Condition").is_in(selected_conditions) & # Condizioni selezionate
+            pl.col("Value").is_between(0, 10) # Stessa estensione dei livelli (da 0 a 10)
+        )
+        density_base = alt.Chart()
+        # Stesse curve in formato wide (una colonna per condizione) per il tooltip della linea verticale
+        density_wide_base = alt.Chart(density_source.pivot(on="Condition", index="Value", values="density"))
+    else:
+        # Curve di densità calcolate dal browser a partire dai dati grezzi delle condizioni selezionate
+        with profiling.block("melt condizioni") as measure:
+            density_source = measure.set_rows(long_data.filter(pl.col("Condition").is_in(selected_conditions)).collect())
+        density_base = (
+            alt.Chart()
+            .transform_density(
+                'Value', # Variabile numerica da convertire in densità
+                as_=['Value', 'density'], # Output della densità
+                groupby=['Condition'] # Calcola la densità per ogni condizione
+            )
+        )
+        density_wide_base = (
+            density_base
+            .transform_pivot(
+                'Condition',                           # Trasforma la condizione in colonne
+                value='density',                       # Valori per ogni condizione
+                groupby=['Value']                      # Raggruppa per i valori
+            )
         )
-    )
-    .properties(height=400) # Altezza del grafico
-)
-
-# Selezione interattiva sul grafico
-nearest = alt.selection_single(
-    fields=['Value'], # Campo per la selezione
-    nearest=True, # Seleziona il punto più vicino
-    on='mousemove', # Attivazione con il movimento del mouse
-    empty='none' # Nessuna selezione se non si è sopra con il mouse
-)
 
-# Crea dinamicamente il tooltip in base alle condizioni selezionate
-tooltip = [
-    alt.Tooltip('Value:Q', title="Valore", format=".2f") # Tooltip per il valore
-    ] + [
-    alt.Tooltip(f'{condition}:Q', title=f"Densità {condition}", format=".4f") # Tooltip per la densità di ogni condizione
-    for condition in selected_conditions
-]
-
-# Linea verticale interattiva con tooltip
-rule = (
-    alt.Chart(filtered_long_data)
-    .transform_density(
-        'Value',                               # Variabile numerica
-        as_=['Value', 'density'],              # Output della densità
-        groupby=['Condition']                  # Calcola la densità per ogni condizione
-    )
-    .transform_pivot(
-        'Condition',                           # Trasforma la condizione in colonne
-        value='density',                       # Valori per ogni condizione
-        groupby=['Value']                      # Raggruppa per i valori
+    # Grafico delle curve di densità
+    condition_dens = (
+        density_base
+        .mark_line(size=2) # Linea per rappresentare la densità
+        .encode(
+            alt.X('Value:Q', 
+                title="Livello delle Condizioni",
+                scale=alt.Scale(domain=[0, 10]) # Misurazioni delle condizioni da 0 a 10
+                ),  
+            alt.Y('density:Q', 
+                title="Densità", 
+                scale=alt.Scale(domain=[0, 0.25]) # Dato che le densità non superano il 0.25, per avere un buon impatto visivo
+                ),              
+            alt.Color(
+                'Condition:N', # Colore in base alla condizione
+                title="Condizione Psichica", # Titolo della legenda
+                scale=alt.Scale(domain=["Anxiety", "Depression", "Insomnia", "OCD"], range=custom_colors)  # Colori personalizzati
+            )
+        )
+        .properties(height=400) # Altezza del grafico
     )
-    .mark_rule(color='black')                  # Linea verticale nera
-    .encode(
-        x='Value:Q',                           # Posizione sulla X
-        tooltip=tooltip,                       # Tooltip dinamico
-        opacity=alt.condition(nearest, alt.value(1), alt.value(0))  # Opacità controllata dalla selezione
+
+    # Selezione interattiva sul grafico
+    nearest = alt.selection_single(
+        fields=['Value'], # Campo per la selezione
+        nearest=True, # Seleziona il punto più vicino
+        on='mousemove', # Attivazione con il movimento del mouse
+        empty='none' # Nessuna selezione se non si è sopra con il mouse
     )
-    .add_selection(nearest)                    # Aggiunge la selezione interattiva
-)
 
-# Punti interattivi per ogni condizione con tooltip
-points = (
-    alt.Chart(filtered_long_data)
-    .transform_density(
-        'Value', # Variabile numerica da trasformare in densità
-        as_=['Value', 'density'], # Output della densità
-        groupby=['Condition'] # Calcola la densità per ogni condizione
+    # Crea dinamicamente il tooltip in base alle condizioni selezionate
+    tooltip = [
+        alt.Tooltip('Value:Q', title="Valore", format=".2f") # Tooltip per il valore
+        ] + [
+        alt.Tooltip(f'{condition}:Q', title=f"Densità {condition}", format=".4f") # Tooltip per la densità di ogni condizione
+        for condition in selected_conditions
+    ]
+
+    # Linea verticale interattiva con tooltip
+    rule = (
+        density_wide_base
+        .mark_rule(color='black')                  # Linea verticale nera
+        .encode(
+            x='Value:Q',                           # Posizione sulla X
+            tooltip=tooltip,                       # Tooltip dinamico
+            opacity=alt.condition(nearest, alt.value(1), alt.value(0))  # Opacità controllata dalla selezione
+        )
+        .add_selection(nearest)                    # Aggiunge la selezione interattiva
     )
-    .mark_circle(size=100) # Punti evidenziati
-    .encode(
-        x='Value:Q', # Posizione sulla X
-        y='density:Q', # Posizione sulla Y
-        color=alt.Color(
-            'Condition:N', # Colore in base alla condizione
-            title="Condizione", # Titolo della legenda
-            scale=alt.Scale(domain=["Anxiety", "Depression", "Insomnia", "OCD"], range=custom_colors)  # Colori personalizzati
-        ),
-        tooltip=[
-            alt.Tooltip('Value:Q', title="Valore", format=".2f"), # Tooltip per il valore
-            alt.Tooltip('Condition:N', title="Condizione"), # Tooltip per la condizione
-            alt.Tooltip('density:Q', title="Densità", format=".4f") # Tooltip per la densità
-        ]
+
+    # Punti interattivi per ogni condizione con tooltip
+    points = (
+        density_base
+        .mark_circle(size=100) # Punti evidenziati
+        .encode(
+            x='Value:Q', # Posizione sulla X
+            y='density:Q', # Posizione sulla Y
+            color=alt.Color(
+                'Condition:N', # Colore in base alla condizione
+                title="Condizione", # Titolo della legenda
+                scale=alt.Scale(domain=["Anxiety", "Depression", "Insomnia", "OCD"], range=custom_colors)  # Colori personalizzati
+            ),
+            tooltip=[
+                alt.Tooltip('Value:Q', title="Valore", format=".2f"), # Tooltip per il valore
+                alt.Tooltip('Condition:N', title="Condizione"), # Tooltip per la condizione
+                alt.Tooltip('density:Q', title="Densità", format=".4f") # Tooltip per la densità
+            ]
+        )
+        .transform_filter(nearest)                 # Mostra i punti solo vicino alla selezione
     )
-    .transform_filter(nearest)                 # Mostra i punti solo vicino alla selezione
-)
 
-# Combina il grafico di densità, la linea verticale e i punti interattivi
-interactive_chart_dens = condition_dens + rule + points
+    # Combina il grafico di densità, la linea verticale e i punti interattivi
+    interactive_chart_dens = charts.layer(density_source, condition_dens, rule, points)
+    return interactive_chart_dens
 
-st.altair_chart(interactive_chart_dens, use_container_width=True)  # Ridimensionamento automatico
+with profiling.block("grafico densità"):
+    charts.altair_chart(
+        "condition_density", build_density_chart, version,
+        state=(tuple(selected_conditions), charts.SERVER_SIDE_AGGREGATION),
+        use_container_width=True # Ridimensionamento automatico
+    )
 
 # Introduzione al grafico delle curve di densità
 st.write("""
@@ -171,62 +214,69 @@ consentendo un'esplorazione dettagliata delle distribuzioni.
 
 ### VIOLIN PLOT PER I LIVELLI DEI QUATTRO DISTURBI
 
-# Trasforma i dati per il violin plot
-violin_data = (
-    long_data
-    .filter(pl.col("Condition").is_in(psych_conditions))  # Filtra solo le condizioni selezionate
-)
-
-## Trasforma i dati per il violin plot
-violin_data = (
-    long_data
-    .filter(pl.col("Condition").is_in(psych_conditions))  # Filtra solo le condizioni selezionate
-)
+# Violini delle quattro condizioni: non dipendono da nessun selettore
+def build_violin_plot():
+    if charts.SERVER_SIDE_AGGREGATION:
+        # Densità già calcolate sull'estensione [-3, 14]
+        violin_base = alt.Chart(condition_densities, width=100)
+    else:
+        # Trasforma i dati per il violin plot
+        with profiling.block("melt condizioni") as measure:
+            violin_data = measure.set_rows(
+                long_data
+                .filter(pl.col("Condition").is_in(psych_conditions))  # Filtra solo le condizioni selezionate
+                .collect()
+            )
+        violin_base = (
+            alt.Chart(violin_data, width=100) # Grafico base
+            .transform_density(
+                'Value', # Variabile su cui calcolare la densità
+                as_=['Value', 'density'], # Colonne risultanti dalla trasformazione
+                extent=[-3, 14], # Estensione dei valori (livelli delle condizioni)
+                groupby=['Condition'] # Raggruppa per condizione
+            )
+        )
 
-# Violin plot per le condizioni psichiche
-cond_violin_plot = (
-    alt.Chart(violin_data, width=100) # Grafico base
-    .transform_density(
-        'Value', # Variabile su cui calcolare la densità
-        as_=['Value', 'density'], # Colonne risultanti dalla trasformazione
-        extent=[-3, 14], # Estensione dei valori (livelli delle condizioni)
-        groupby=['Condition'] # Raggruppa per condizione
-    )
-    .mark_area(orient='horizontal') # Area per rappresentare i violini
-    .encode(
-        x = alt.X('density:Q') # Asse X: densità
-                .stack('center') # Centra i violini
-                .axis(None), # Configurazione dell'asse (no assi x in quanto non servono)
-        y = alt.Y('Value:Q', title="Livello"), # Asse Y: livelli delle condizioni
-        color = alt.Color(
-                'Condition:N', # Colore in base alla condizione
-                scale=alt.Scale(
-                    domain=["Anxiety", "Depression", "Insomnia", "OCD"], 
-                    range=custom_colors
+    # Violin plot per le condizioni psichiche
+    cond_violin_plot = (
+        violin_base
+        .mark_area(orient='horizontal') # Area per rappresentare i violini
+        .encode(
+            x = alt.X('density:Q') # Asse X: densità
+                    .stack('center') # Centra i violini
+                    .axis(None), # Configurazione dell'asse (no assi x in quanto non servono)
+            y = alt.Y('Value:Q', title="Livello"), # Asse Y: livelli delle condizioni
+            color = alt.Color(
+                    'Condition:N', # Colore in base alla condizione
+                    scale=alt.Scale(
+                        domain=["Anxiety", "Depression", "Insomnia", "OCD"], 
+                        range=custom_colors
+                )
+            ), # Colori personalizzati
+            column = alt.Column(
+                    'Condition:N', # Facettatura per condizione
+                    spacing=0, # Spaziatura tra i facetti
+                    header=alt.Header(
+                        titleOrient='bottom', 
+                        labelOrient='bottom', 
+                        labelPadding=5
+                ) # Configurazione dell'header
             )
-        ), # Colori personalizzati
-        column = alt.Column(
-                'Condition:N', # Facettatura per condizione
-                spacing=0, # Spaziatura tra i facetti
-                header=alt.Header(
-                    titleOrient='bottom', 
-                    labelOrient='bottom', 
-                    labelPadding=5
-            ) # Configurazione dell'header
         )
-    )
-    .configure_view(stroke=None) # Rimuove i bordi attorno ai violini
-    .properties(
-        height = 400,
-        width = 140,
-        title="Distribuzione delle Condizioni Psichiche"
-    )
-    .configure_title(fontSize=25) # Imposta un font più grande per i titoli del grafico
+        .configure_view(stroke=None) # Rimuove i bordi attorno ai violini
+        .properties(
+            height = 400,
+            width = 140,
+            title="Distribuzione delle Condizioni Psichiche"
+        )
+        .configure_title(fontSize=25) # Imposta un font più grande per i titoli del grafico
 
-)
+    )
+    return cond_violin_plot
 
 # Mostra il grafico in Streamlit
-st.altair_chart(cond_violin_plot)
+with profiling.block("grafico violini"):
+    charts.altair_chart("condition_violin", build_violin_plot, version, state=(charts.SERVER_SIDE_AGGREGATION,))
 
 st.write("""
 
@@ -259,57 +309,112 @@ selected_condition = st.selectbox(
     key="bubble_chart_condition"
 )
 
-# Aggregazione dei dati per età
-aggregated_data = (
-    data.group_by("Age")
-    .agg([
-        pl.col(selected_condition).mean().alias("mean_condition"),  # Media della condizione per età
-        pl.col(selected_condition).count().alias("count")  # Numero di rispondenti per età
-    ])
-)
+# Intervalli di confidenza bootstrap della media per età e curva lisciata (le età con pochi rispondenti hanno medie
+# molto variabili); calcolati una sola volta per condizione e versione del dataset (vedi bootstrap.py)
+SMOOTHING_BANDWIDTH = 3 # Ampiezza (in anni) del kernel della curva lisciata
+show_condition_ci = st.checkbox("Mostra gli intervalli di confidenza al 95% (bootstrap)", key="bubble_ci")
+show_condition_smooth = st.checkbox("Mostra la curva lisciata con la sua banda di confidenza", key="bubble_smooth")
+if show_condition_ci or show_condition_smooth:
+    with profiling.block("bootstrap condizione per età") as measure:
+        condition_ci, condition_smooth = measure.set_rows(bootstrap.get_age_bootstrap(
+            selected_condition,
+            bandwidth=SMOOTHING_BANDWIDTH if show_condition_smooth else None
+        ))
+
+# Bolle per età della condizione selezionata con i layer opzionali del bootstrap
+def build_bubble_chart():
+    # Aggregazione dei dati per età: media della condizione e numero di rispondenti per età, ricavati dalle somme per età
+    # mantenute aggiornate in modo incrementale (vedi ingestion.py), senza rileggere i dati ad ogni cambio di condizione
+    with profiling.block("aggregazione per età") as measure:
+        age_sums = ingestion.get_survey_state()["grouped"]["age"]
+        aggregated_data = measure.set_rows(
+            moments.grouped_mean_variance(age_sums, "Age", selected_condition)
+            .select(
+                "Age",
+                pl.col("mean").alias("mean_condition"),  # Media della condizione per età
+                "count"  # Numero di rispondenti per età
+            )
+        )
 
-# Crea una selezione interattiva per l'highlight
-highlight = alt.selection_single(
-    on="mouseover",  # Attiva l'highlight al passaggio del mouse
-    empty="none",  # Nessuna selezione di default
-    fields=["Age", "mean_condition"]  # Campi su cui effettuare la selezione
-)
+    # Crea una selezione interattiva per l'highlight
+    highlight = alt.selection_single(
+        on="mouseover",  # Attiva l'highlight al passaggio del mouse
+        empty="none",  # Nessuna selezione di default
+        fields=["Age", "mean_condition"]  # Campi su cui effettuare la selezione
+    )
 
-# Creazione del grafico a bolle con highlight e contorno nero
-bubble_chart = (
-    alt.Chart(aggregated_data)
-    .mark_circle(strokeWidth=2)  # Imposta lo spessore del contorno
-    .encode(
-        x=alt.X("Age:Q", title="Età"),  # Asse X con l'età
-        y=alt.Y("mean_condition:Q", title=f"Media Livello di {selected_condition}"),  # Asse Y con la media
-        size=alt.Size("count:Q", title="Numero di Rispondenti", scale=alt.Scale(range=[40, 450])),  # Dimensione delle bolle
-        color=alt.Color(
-            "count:Q",
-            title="Numero di Rispondenti",
-            scale=alt.Scale(scheme="cividis")  # Colore in base al numero di rispondenti (ottimizzato per daltonismo)
-        ),
-        opacity=alt.condition(
-            highlight,  # Cambia l'opacità in base alla selezione
-            alt.value(1),  # Opacità completa per la bolla evidenziata
-            alt.value(0.7)  # Trasparenza per le altre bolle
-        ),
-        stroke=alt.condition(
-            highlight,  # Cambia il colore del contorno in base alla selezione
-            alt.value("black"),  # Contorno nero per la bolla evidenziata
-            alt.value(None)  # Nessun contorno per le altre bolle
-        ),
-        tooltip=[
-            alt.Tooltip("Age:Q", title="Età"),
-            alt.Tooltip("mean_condition:Q", title=f"Media {selected_condition}", format=".2f"),
-            alt.Tooltip("count:Q", title="Numero di Rispondenti")
-        ]
+    # Creazione del grafico a bolle con highlight e contorno nero
+    bubble_chart = (
+        alt.Chart(aggregated_data)
+        .mark_circle(strokeWidth=2)  # Imposta lo spessore del contorno
+        .encode(
+            x=alt.X("Age:Q", title="Età"),  # Asse X con l'età
+            y=alt.Y("mean_condition:Q", title=f"Media Livello di {selected_condition}"),  # Asse Y con la media
+            size=alt.Size("count:Q", title="Numero di Rispondenti", scale=alt.Scale(range=[40, 450])),  # Dimensione delle bolle
+            color=alt.Color(
+                "count:Q",
+                title="Numero di Rispondenti",
+                scale=alt.Scale(scheme="cividis")  # Colore in base al numero di rispondenti (ottimizzato per daltonismo)
+            ),
+            opacity=alt.condition(
+                highlight,  # Cambia l'opacità in base alla selezione
+                alt.value(1),  # Opacità completa per la bolla evidenziata
+                alt.value(0.7)  # Trasparenza per le altre bolle
+            ),
+            stroke=alt.condition(
+                highlight,  # Cambia il colore del contorno in base alla selezione
+                alt.value("black"),  # Contorno nero per la bolla evidenziata
+                alt.value(None)  # Nessun contorno per le altre bolle
+            ),
+            tooltip=[
+                alt.Tooltip("Age:Q", title="Età"),
+                alt.Tooltip("mean_condition:Q", title=f"Media {selected_condition}", format=".2f"),
+                alt.Tooltip("count:Q", title="Numero di Rispondenti")
+            ]
+        )
+        .add_selection(highlight)  # Aggiunge la selezione interattiva
+        .properties(height=500)
     )
-    .add_selection(highlight)  # Aggiunge la selezione interattiva
-    .properties(height=500)
-)
+
+    # Layer opzionali sotto le bolle: barre degli intervalli di confidenza e curva lisciata con la sua banda
+    bootstrap_layers = []
+    if show_condition_smooth:
+        smooth_base = alt.Chart(condition_smooth)
+        bootstrap_layers += [
+            smooth_base.mark_area(color="orange", opacity=0.25).encode(x="Age:Q", y="ci_low:Q", y2="ci_high:Q"),
+            smooth_base.mark_line(color="orange", size=3).encode(x="Age:Q", y="mean:Q")
+        ]
+    if show_condition_ci:
+        bootstrap_layers.append(
+            alt.Chart(condition_ci)
+            .mark_rule(color="gray")
+            .encode(
+                x="Age:Q",
+                y="ci_low:Q", # Estremo inferiore dell'intervallo
+                y2="ci_high:Q", # Estremo superiore dell'intervallo
+                tooltip=[
+                    alt.Tooltip("Age:Q", title="Età"),
+                    alt.Tooltip("ci_low:Q", title="IC 95% (inferiore)", format=".2f"),
+                    alt.Tooltip("ci_high:Q", title="IC 95% (superiore)", format=".2f")
+                ]
+            )
+        )
+    if bootstrap_layers:
+        bubble_chart = alt.layer(*bootstrap_layers, bubble_chart)
+    return bubble_chart
 
 # Mostra il grafico in Streamlit
-st.altair_chart(bubble_chart, use_container_width=True)
+with profiling.block("grafico a bolle"):
+    charts.altair_chart(
+        "condition_by_age", build_bubble_chart, version,
+        state=(selected_condition, show_condition_ci, show_condition_smooth),
+        use_container_width=True
+    )
+if show_condition_ci:
+    st.caption(
+        f"Le età con meno di {bootstrap.MIN_CI_COUNT} rispondenti non hanno un intervallo di confidenza (nessuna barra grigia): "
+        "per queste età vale solo la banda della curva lisciata."
+    )
 
 st.write("""
 Questo grafico a bolle aggrega i dati per età e mostra la relazione tra 
@@ -324,59 +429,58 @@ in base al numero di rispondenti stessi.
 
 ### HEATMAP CON CORRELAZIONI TRA LE CONDIZIONI
 
-# Calcolo della matrice di correlazione
-conditions_data = data.select(psych_conditions)  # Estrai solo le condizioni psichiche
-correlation_matrix = np.corrcoef(
-    [conditions_data[col] for col in psych_conditions]
-)
+# Heatmap delle correlazioni: la tabella viene letta solo se la specifica non è già nella cache
+def build_correlation_chart():
+    # Matrice di correlazione in formato long (una riga per coppia di condizioni), calcolata una sola volta per versione
+    # del dataset con i momenti a coppie (vedi moments.PairwiseMoments)
+    with profiling.block("correlazioni") as measure:
+        correlation_df = measure.set_rows(
+            aggregates.get_correlation_table(psych_conditions)
+            .rename({"Variable1": "Condition1", "Variable2": "Condition2"})
+        )
 
-# Creazione del DataFrame per la heatmap
-correlation_df = pl.DataFrame({
-    "Condition1": np.repeat(psych_conditions, len(psych_conditions)),
-    "Condition2": np.tile(psych_conditions, len(psych_conditions)),
-    "Correlation": correlation_matrix.flatten()
-})
-
-# Heatmap con i valori di correlazione
-heatmap = (
-    alt.Chart(correlation_df)
-    .mark_rect()
-    .encode(
-        x=alt.X("Condition1:N", title="Condizione Psichica", axis=alt.Axis(labelAngle=0)),
-        y=alt.Y("Condition2:N", title="Condizione Psichica"),
-        color=alt.Color(
-            "Correlation:Q",
-            scale=alt.Scale(scheme="redyellowgreen", domain=[-1, 1]),
-            title="Correlazione"
+    # Heatmap con i valori di correlazione
+    heatmap = (
+        alt.Chart() # Dati ereditati dal grafico combinato
+        .mark_rect()
+        .encode(
+            x=alt.X("Condition1:N", title="Condizione Psichica", axis=alt.Axis(labelAngle=0)),
+            y=alt.Y("Condition2:N", title="Condizione Psichica"),
+            color=alt.Color(
+                "Correlation:Q",
+                scale=alt.Scale(scheme="redyellowgreen", domain=[-1, 1]),
+                title="Correlazione"
+            )
+        )
+        .properties(
+            title="Matrice di Correlazione tra le Condizioni Psichiche",
+            height=400
         )
     )
-    .properties(
-        title="Matrice di Correlazione tra le Condizioni Psichiche",
-        height=400
-    )
-)
 
-# Aggiunta dei valori di correlazione come testo
-text = (
-    alt.Chart(correlation_df)
-    .mark_text()
-    .encode(
-        x=alt.X("Condition1:N", title=None, axis=alt.Axis(labelAngle=0)),
-        y=alt.Y("Condition2:N", title=None),
-        text=alt.Text("Correlation:Q", format=".2f"),  # Valori di correlazione con 2 decimali
-        color=alt.condition(
-            "datum.Correlation > 0.5 || datum.Correlation < -0.5",
-            alt.value("white"),  # Testo bianco per forti correlazioni (per renderlo leggibile)
-            alt.value("black")   # Testo nero per deboli correlazioni (per renderlo leggibile)
+    # Aggiunta dei valori di correlazione come testo
+    text = (
+        alt.Chart() # Stessi dati della heatmap
+        .mark_text()
+        .encode(
+            x=alt.X("Condition1:N", title=None, axis=alt.Axis(labelAngle=0)),
+            y=alt.Y("Condition2:N", title=None),
+            text=alt.Text("Correlation:Q", format=".2f"),  # Valori di correlazione con 2 decimali
+            color=alt.condition(
+                "datum.Correlation > 0.5 || datum.Correlation < -0.5",
+                alt.value("white"),  # Testo bianco per forti correlazioni (per renderlo leggibile)
+                alt.value("black")   # Testo nero per deboli correlazioni (per renderlo leggibile)
+            )
         )
     )
-)
 
-# Grafico combinato
-correlation_chart = (heatmap + text).configure_title(fontSize=25) # Imposta un font più grande per i titoli del grafico
+    # Grafico combinato
+    correlation_chart = charts.layer(correlation_df, heatmap, text).configure_title(fontSize=25) # Imposta un font più grande per i titoli del grafico
+    return correlation_chart
 
 # Mostra il grafico in Streamlit
-st.altair_chart(correlation_chart, use_container_width=True)
+with profiling.block("grafico correlazioni"):
+    charts.altair_chart("condition_correlation", build_correlation_chart, version, use_container_width=True)
 
 st.write("""
 La matrice di correlazione evidenzia la relazione tra le diverse condizioni psichiche. 
@@ -389,3 +493,5 @@ La matrice di correlazione evidenzia la relazione tra le diverse condizioni psic
 
 Questi risultati evidenziano l'importanza di indagare ulteriormente le relazioni più forti, come quella tra Anxiety e Depression, per comprendere meglio le dinamiche delle condizioni psichiche.
 """)
+
+profiling.report() # Fine della riesecuzione: misure nel pannello e nel log
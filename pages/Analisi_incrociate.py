@@ -1,11 +1,13 @@
 import altair as alt
 import polars as pl
 import streamlit as st
-import numpy as np
-import plotly.express as px # Per il grafico 3D
 import plotly.graph_objects as go # Per il grafico 3D
-from sklearn.linear_model import LinearRegression # Per il piano nel grafico 3D
+import aggregates
+import charts
 import data_cleaning
+import permutation # Per i test di permutazione nella heatmap
+import profiling
+import regression # Per il piano nel grafico 3D
 
 # Imposta il nome che viene fuori nel browser con emoji
 st.set_page_config(
@@ -13,8 +15,13 @@ st.set_page_config(
     page_icon="🔀"
 )
 
-# Importo i dati con la funzione definita in data_cleaning.py (get_data)
-data = data_cleaning.get_data()
+# Misura dei blocchi della pagina ad ogni riesecuzione (pannello "Profiling" nella barra laterale, se attivo)
+profiling.start_run("Analisi incrociate")
+
+# Importo i dati con la funzione definita in data_cleaning.py (get_data_lazy): è un piano lazy, 
+# i dati vengono letti solo quando i piani costruiti sotto vengono eseguiti
+data = data_cleaning.get_data_lazy()
+version = data_cleaning.get_data_version() # Versione del dataset: con lo stato dei selettori identifica le specifiche dei grafici già compilate
 
 # Titolo della pagina
 st.title("Analisi Incrociate: Relazioni tra Musica e Benessere Psichico")
@@ -32,45 +39,64 @@ Ad esempio, è possibile osservare se il livello di depressione è in qualche mo
 
 
 
-### ISTOGRAMMA SULL'EFFETTO DELLA MUSICA
-
-# Rimuovi i valori mancanti nella colonna "Music effects"
-filtered_data = data.filter(pl.col("Music effects").is_not_null())
+### PREPARAZIONE DEI DATI
 
-# Calcola conteggi e percentuali
+# Istogramma: conteggi e percentuali degli effetti della musica (rimuovendo i valori mancanti)
 music_effects_counts = (
-    filtered_data
+    data.filter(pl.col("Music effects").is_not_null())
     .group_by("Music effects")  # Raggruppa i dati per la colonna "Music effects"
-    .count()  # Conta il numero di occorrenze per ogni categoria
-    .rename({"count": "count"})  # Rinomina la colonna "count" per chiarezza
+    .agg(pl.len().alias("count"))  # Conta il numero di occorrenze per ogni categoria
     .with_columns(
-        (pl.col("count") / filtered_data.height).alias("percentage")  # Calcola la percentuale per il tooltip
+        (pl.col("count") / pl.col("count").sum()).alias("percentage")  # Calcola la percentuale per il tooltip
     )
 )
 
-# Istogramma 
-music_effects_histogram = (
-    alt.Chart(music_effects_counts)
-    .mark_bar() # Istogramma (grafico a barre)
-    .encode(
-        x=alt.X("Music effects:N", title="Effetti della Musica"),
-        y=alt.Y("count:Q", title="Conteggio"),
-        color=alt.Color("Music effects:N", title="Effetti della Musica"), # Colore in base alle modalità della variabile Music effects
-        tooltip=[ # Tooltip con effetto, frequenze assolute e relative
-            alt.Tooltip("Music effects:N", title="Effetto"),
-            alt.Tooltip("count:Q", title="Conteggio"),
-            alt.Tooltip("percentage:Q", title="Percentuale", format=".2%")
-        ]
-    )
-    .properties(
-        title="Distribuzione degli Effetti della Musica",
-        height=500
+# Grafico 3D: elimina eventuali NaN nelle variabili di interesse e seleziona solo le colonne usate
+data_cleaned = (
+    data.filter(
+        (pl.col("Hours per day").is_not_null()) &
+        (pl.col("Age").is_not_null())
     )
-    .configure_title(fontSize=27)  # Imposta un font più grande per i titoli del grafico
+    .select(["Age", "Hours per day", "Depression", "Anxiety", "OCD", "Insomnia"])
 )
 
+# Esegue tutti i piani insieme
+with profiling.block("effetti della musica e dati 3D") as measure:
+    music_effects_counts, data_cleaned = measure.set_rows(pl.collect_all([music_effects_counts, data_cleaned]))
+
+
+
+
+
+### ISTOGRAMMA SULL'EFFETTO DELLA MUSICA
+
+# Istogramma degli effetti (costruito solo se la specifica non è già nella cache, vedi charts.altair_chart)
+def build_music_effects_histogram():
+    # Istogramma 
+    music_effects_histogram = (
+        alt.Chart(music_effects_counts)
+        .mark_bar() # Istogramma (grafico a barre)
+        .encode(
+            x=alt.X("Music effects:N", title="Effetti della Musica"),
+            y=alt.Y("count:Q", title="Conteggio"),
+            color=alt.Color("Music effects:N", title="Effetti della Musica"), # Colore in base alle modalità della variabile Music effects
+            tooltip=[ # Tooltip con effetto, frequenze assolute e relative
+                alt.Tooltip("Music effects:N", title="Effetto"),
+                alt.Tooltip("count:Q", title="Conteggio"),
+                alt.Tooltip("percentage:Q", title="Percentuale", format=".2%")
+            ]
+        )
+        .properties(
+            title="Distribuzione degli Effetti della Musica",
+            height=500
+        )
+        .configure_title(fontSize=27)  # Imposta un font più grande per i titoli del grafico
+    )
+    return music_effects_histogram
+
 # Mostra il grafico in Streamlit
-st.altair_chart(music_effects_histogram, use_container_width=True)
+with profiling.block("grafico effetti della musica"):
+    charts.altair_chart("music_effects", build_music_effects_histogram, version, use_container_width=True)
 
 st.write("""
 Dal grafico emerge che una significativa maggioranza degli utenti, pari al **74.45%**, percepisce miglioramenti nelle proprie condizioni psichiche durante l'ascolto di musica.  
@@ -89,16 +115,8 @@ Infine, il restante **23.21%** degli utenti dichiara di non percepire effetti si
 
 ### GRAFICO 3D CHE INCROCIA ETÀ, LIVELLO DELLA CONDIZIONE SELEZIONATA E ORE DI ASCOLTO 
 
-# Filtra i dati per eliminare eventuali NaN nelle variabili di interesse
-data_cleaned = data.filter(
-    (pl.col("Hours per day").is_not_null()) &
-    (pl.col("Age").is_not_null())
-)
-
-# Conversione in Pandas per compatibilità Plotly (altrimenti non funziona)
-data_pandas = data_cleaned.select([
-    "Age", "Hours per day", "Depression", "Anxiety", "OCD", "Insomnia"
-]).to_pandas() 
+# Numero massimo di punti disegnati nel grafico 3D
+MAX_3D_POINTS = 5000
 
 # Selezione della condizione
 st.write("### Relazione tra età, ore di ascolto e condizione psichica")
@@ -107,13 +125,24 @@ condition = st.selectbox(
     ["Depression", "Anxiety", "OCD", "Insomnia"]
 )
 
-# Definizione delle variabili esplicative (age, hours per day) e della variabile risposta (condition)
-X = data_pandas[["Age", "Hours per day"]]
-y = data_pandas[condition]
-
-# Creazione del modello lineare 
-model = LinearRegression()
-model.fit(X, y)
+# Modello lineare con variabili esplicative età e ore di ascolto (x1, x2) e variabile risposta la condizione selezionata:
+# i modelli delle quattro condizioni vengono stimati insieme una sola volta per versione del dataset (vedi regression.py)
+with profiling.block("modelli di regressione"):
+    model = regression.get_condition_models()[condition]
+
+# Punti da disegnare: oltre MAX_3D_POINTS righe i punti vengono ridotti con una griglia di voxel, 
+# riservando metà dei punti agli utenti che ascoltano più di 10 ore al giorno (gli outlier citati sotto: tutti finché ci stanno)
+with profiling.block("punti grafico 3D") as measure:
+    points_3d, dropped_points = charts.downsample_3d(
+        data_cleaned, "Age", "Hours per day", condition,
+        max_points=MAX_3D_POINTS,
+        keep=pl.col("Hours per day") > 10
+    )
+    measure.set_rows(points_3d)
+# Le colonne vengono passate a Plotly come array NumPy (senza copia per colonne numeriche senza valori nulli)
+x_points = points_3d["Age"].to_numpy()
+y_points = points_3d["Hours per day"].to_numpy()
+z_points = points_3d[condition].to_numpy()
 
 # Crea il grafico 3D
 fig = go.Figure()
@@ -121,42 +150,17 @@ fig = go.Figure()
 # Aggiungi i punti delle osservazioni
 fig.add_trace(
     go.Scatter3d(
-        x=data_pandas["Age"],
-        y=data_pandas["Hours per day"],
-        z=data_pandas[condition],
+        x=x_points,
+        y=y_points,
+        z=z_points,
         mode='markers',
-        marker=dict(size=5, color=data_pandas[condition], colorscale="Plasma"),
+        marker=dict(size=5, color=z_points, colorscale="Plasma"),
         name="Dati"
     )
 )
 
-# Crea una gamma di valori uniforme per l'età
-x_range = (
-    np.linspace(
-        data_pandas["Age"].min(), 
-        data_pandas["Age"].max(), 
-        10)
-)  
-
-# Crea una gamma di valori uniforme per le ore di ascolto
-y_range = (
-    np.linspace(
-        data_pandas["Hours per day"].min(), 
-        data_pandas["Hours per day"].max(), 
-        10)
-)  
-
-# Genera una griglia 2D combinando x_range e y_range
-x_grid, y_grid = np.meshgrid(x_range, y_range)  
-
-# Predice i valori della condizione per ogni combinazione della griglia e la rimappa alla forma della griglia
-z_grid = (
-    model.predict(
-        np.c_[x_grid.ravel(),
-        y_grid.ravel()]
-        )
-        .reshape(x_grid.shape)
-)  
+# Griglia del piano (età x ore di ascolto) con i valori della condizione già predetti dal modello
+x_grid, y_grid, z_grid = model["x_grid"], model["y_grid"], model["z_grid"]
 
 # Aggiungi il piano di regressione 
 fig.add_trace(
@@ -183,15 +187,30 @@ fig.update_layout(
 )
 
 # Mostra il grafico in Streamlit
-st.plotly_chart(fig, use_container_width=True)
+with profiling.block("grafico 3D"):
+    st.plotly_chart(fig, use_container_width=True)
+
+if dropped_points > 0: # Avvisa se non tutti i punti sono stati disegnati
+    st.caption(
+        f"Per contenere le dimensioni del grafico sono mostrati {points_3d.height} punti su {data_cleaned.height} "
+        f"({dropped_points} punti raggruppati con quelli vicini); il piano di regressione è stimato su tutti i dati."
+    )
 
 # Coefficienti del modello con la condizione selezionata
-beta_0 = model.intercept_  # Intercetta
-beta_1, beta_2 = model.coef_  # Coefficienti per "Age" (x1) e "Hours per day" (x2)
+beta_0 = model["intercept"]  # Intercetta
+beta_1, beta_2 = model["coef"]  # Coefficienti per "Age" (x1) e "Hours per day" (x2)
 
 # Mostra l'equazione del piano di regressione per la condizione selezionata
 st.latex(rf"\text{{Equazione del piano di regressione per {condition}: }} \hat{{y}} = {beta_0:.2f} + {beta_1:.2f} \cdot x_1 + {beta_2:.2f} \cdot x_2")
 
+# Bontà di adattamento ed errori standard delle stime
+se_0 = model["intercept_se"]
+se_1, se_2 = model["coef_se"]
+st.caption(
+    f"$R^2$ = {model['r2']:.3f} (n = {model['n']}) — errori standard: "
+    f"$\\beta_0$ {se_0:.3f}, $\\beta_1$ {se_1:.3f}, $\\beta_2$ {se_2:.3f}"
+)
+
 st.write("""
 Dalla visualizzazione 3D si nota che la maggior parte degli utenti ascolta al massimo 10 ore al giorno di musica. 
 Si nota una decina di outlier che vanno oltre la soglia delle 10 ore al giorno.
@@ -257,76 +276,115 @@ Il modello ha i seguenti obiettivi:
 
 
 
-# Filtra i dati: rimuove i valori nulli
-filtered_data = data.filter(
-    (pl.col("Fav genre").is_not_null()) &
-    (pl.col("Depression").is_not_null()) &
-    (pl.col("Anxiety").is_not_null()) &
-    (pl.col("OCD").is_not_null()) &
-    (pl.col("Insomnia").is_not_null())
-)
-
-# Trasforma i dati in long data per creare la heatmap
-data_long = filtered_data.melt(
-    id_vars=["Fav genre"],
-    value_vars=["Depression", "Anxiety", "OCD", "Insomnia"],
-    variable_name="Condition",
-    value_name="Level"
-)
+# Test di permutazione (10.000 permutazioni, calcolati una sola volta per versione del dataset, vedi permutation.py):
+# per ogni genere e condizione la differenza tra la media del genere e quella degli altri rispondenti, con i p-value
+# corretti per i 64 confronti. Le celle con p-value corretto sotto 0.05 sono segnate con un asterisco.
+# I test vengono eseguiti solo su richiesta (oltre permutation.MAX_EXACT_ROWS risposte con l'approssimazione normale)
+SIGNIFICANCE_LEVEL = 0.05
+correction = None # Nessun test: la heatmap mostra solo le medie
+genre_condition_tests = None
+if st.checkbox("Verifica le differenze tra generi con i test di permutazione", key="permutation_tests"):
+    correction = st.radio(
+        "Correzione per i confronti multipli:",
+        options=["holm", "bh"],
+        format_func={"holm": "Holm (probabilità di almeno un falso positivo)", "bh": "Benjamini-Hochberg (proporzione di falsi positivi)"}.get,
+        horizontal=True
+    )
+    with profiling.block("test di permutazione") as measure:
+        genre_condition_tests = measure.set_rows(permutation.get_genre_condition_tests(correction=correction))
+
+# Heatmap con i valori e gli asterischi: statistiche e join vengono calcolati solo se la specifica non è già nella cache
+def build_heatmap():
+    # Statistiche per genere musicale e condizione (numero di rispondenti, media, varianza, mediana e intervallo di confidenza al 95%),
+    # calcolate una sola volta per versione del dataset (vedi aggregates.py)
+    with profiling.block("statistiche per genere e condizione") as measure:
+        genre_condition_cube = measure.set_rows(aggregates.get_genre_condition_cube())
+    heatmap_data = genre_condition_cube.rename({"mean": "Average Level"}) # Media dei livelli per combinazione di genere musicale e condizione
+
+    label = pl.col("Average Level").round(1).cast(pl.String) # Valore mostrato nella cella
+    test_tooltips = []
+    if genre_condition_tests is None:
+        heatmap_data = heatmap_data.with_columns(label.alias("label"))
+    else:
+        heatmap_data = (
+            heatmap_data
+            .join(genre_condition_tests.select("Fav genre", "Condition", "difference", "p_value", "p_adjusted"), on=["Fav genre", "Condition"], how="left")
+            .with_columns(
+                pl.when(pl.col("p_adjusted") < SIGNIFICANCE_LEVEL)
+                .then(label + "*")
+                .otherwise(label)
+                .alias("label")
+            )
+        )
+        test_tooltips = [
+            alt.Tooltip("difference:Q", title="Differenza dagli altri generi", format="+.2f"),
+            alt.Tooltip("p_value:Q", title="p-value (permutazioni)", format=".4f"),
+            alt.Tooltip("p_adjusted:Q", title="p-value corretto", format=".4f"),
+        ]
 
-# Calcola la media dei livelli per combinazione di genere musicale e condizione
-heatmap_data = data_long.group_by(["Fav genre", "Condition"]).agg(
-    pl.col("Level").mean().alias("Average Level")
-).to_pandas()  # Converti in Pandas per Altair
-
-# Ordina i generi musicali in base alla media generale dei livelli
-heatmap_order = (
-    heatmap_data.groupby("Fav genre")["Average Level"]
-    .mean()
-    .sort_values(ascending=False)
-    .index.tolist()
-)
+    # Ordina i generi musicali in base alla media generale dei livelli (direttamente con Polars, senza passare da Pandas)
+    heatmap_order = (
+        heatmap_data.group_by("Fav genre")
+        .agg(pl.col("Average Level").mean())
+        .sort("Average Level", descending=True)
+        .get_column("Fav genre")
+        .to_list()
+    )
 
-# Heatmap
-heatmap = (
-    alt.Chart(heatmap_data)
-    .mark_rect()
-    .encode(
-        x=alt.X("Fav genre:N", title="Genere Musicale", sort=heatmap_order),
-        y=alt.Y("Condition:N", title="Condizione Psichica"),
-        color=alt.Color(
-            "Average Level:Q",
-            title="Livello Medio",
-            scale=alt.Scale(scheme="spectral"),  # Migliora leggibilità
-        ),
-        tooltip=[
-            alt.Tooltip("Fav genre:N", title="Genere Musicale"),
-            alt.Tooltip("Condition:N", title="Condizione Psichica"),
-            alt.Tooltip("Average Level:Q", title="Livello Medio", format=".1f"),
-        ],
+    # Heatmap
+    heatmap = (
+        alt.Chart() # Dati ereditati dal grafico combinato
+        .mark_rect()
+        .encode(
+            x=alt.X("Fav genre:N", title="Genere Musicale", sort=heatmap_order),
+            y=alt.Y("Condition:N", title="Condizione Psichica"),
+            color=alt.Color(
+                "Average Level:Q",
+                title="Livello Medio",
+                scale=alt.Scale(scheme="spectral"),  # Migliora leggibilità
+            ),
+            tooltip=[
+                alt.Tooltip("Fav genre:N", title="Genere Musicale"),
+                alt.Tooltip("Condition:N", title="Condizione Psichica"),
+                alt.Tooltip("Average Level:Q", title="Livello Medio", format=".1f"),
+                alt.Tooltip("ci_low:Q", title="IC 95% (inferiore)", format=".1f"),
+                alt.Tooltip("ci_high:Q", title="IC 95% (superiore)", format=".1f"),
+                alt.Tooltip("count:Q", title="Numero di Rispondenti"),
+                *test_tooltips
+            ],
+        )
+        .properties(height=600)
     )
-    .properties(height=600)
-)
 
-# Aggiungi i valori numerici alle celle
-text = (
-    alt.Chart(heatmap_data)
-    .mark_text(baseline="middle")
-    .encode(
-        x=alt.X("Fav genre:N", sort=heatmap_order),
-        y=alt.Y("Condition:N"),
-        text=alt.Text("Average Level:Q", format=".1f"),
-        color=alt.value("black"),  # Testo leggibile
+    # Aggiungi i valori numerici alle celle
+    text = (
+        alt.Chart() # Stessi dati della heatmap
+        .mark_text(baseline="middle")
+        .encode(
+            x=alt.X("Fav genre:N", sort=heatmap_order),
+            y=alt.Y("Condition:N"),
+            text=alt.Text("label:N"), # Media con un decimale (e asterisco se la differenza è significativa)
+            color=alt.value("black"),  # Testo leggibile
+        )
     )
-)
 
-# Combina la heatmap con i valori numerici
-combined_chart = (heatmap + text).properties(
-    title="Condizioni psichiche per genere musicale preferito"
-).configure_title(fontSize=27)
+    # Combina la heatmap con i valori numerici
+    combined_chart = charts.layer(heatmap_data, heatmap, text).properties(
+        title="Condizioni psichiche per genere musicale preferito"
+    ).configure_title(fontSize=27)
+    return combined_chart
 
 # Mostra il grafico in Streamlit
-st.altair_chart(combined_chart, use_container_width=True)
+with profiling.block("grafico heatmap"):
+    charts.altair_chart("genre_condition_heatmap", build_heatmap, version, state=(correction,), use_container_width=True)
+
+if genre_condition_tests is not None:
+    significant = genre_condition_tests.filter(pl.col("p_adjusted") < SIGNIFICANCE_LEVEL)
+    st.caption(
+        f"Test di permutazione: {significant.height} combinazioni di genere e condizione su {genre_condition_tests.height} "
+        f"hanno una media diversa da quella degli altri rispondenti con p-value corretto sotto {SIGNIFICANCE_LEVEL} (segnate con *)."
+        + (" Le differenze descritte sotto vanno quindi lette come tendenze, non come effetti dimostrati." if significant.is_empty() else "")
+    )
 
 st.write("""
 Dal grafico emerge che:
@@ -340,3 +398,4 @@ Il genere *Lofi* sembra associato a livelli più elevati di ansia, depressione e
 Al contrario, generi come *Latin* e *Gospel* mostrano valori più bassi in tutte le condizioni, specialmente per l'OCD. 
 """)
 
+profiling.report() # Fine della riesecuzione: misure nel pannello e nel log
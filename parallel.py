@@ -0,0 +1,155 @@
+import argparse
+import glob
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import data_cleaning
+import streaming
+
+SHARD_EXTENSIONS = (".csv", ".parquet", ".arrow", ".ipc", ".feather") # File considerati shard in una cartella
+SHARD_CACHE_DIR = os.path.join(data_cleaning.CACHE_DIR, "shards") # Risultati parziali salvati, una cartella per shard
+
+
+# Aggregazione in parallelo di un export diviso in più file (shard), es. uno per ondata di raccolta e regione.
+# Per ogni shard vengono calcolati i risultati parziali additivi di streaming.partial_plans (istogrammi, conteggi per
+# gruppo, somme dei momenti, sketch dei quantili), che poi vengono uniti e trasformati nelle tabelle delle pagine.
+# I risultati parziali di ogni versione dello shard (percorso, data di modifica, dimensione, età esclusa) restano in
+# memoria e vengono salvati su disco in SHARD_CACHE_DIR, quindi sono riusati anche tra esecuzioni diverse da riga di
+# comando: dopo un caricamento notturno vengono elaborati solo gli shard nuovi o modificati.
+
+
+# Shard di una sorgente: tutti i file di una cartella (anche nelle sottocartelle), un pattern o un singolo file
+def find_shards(source):
+    if os.path.isdir(source):
+        files = glob.glob(os.path.join(source, "**", "*"), recursive=True)
+        files = [file for file in files if os.path.splitext(file)[1].lower() in SHARD_EXTENSIONS]
+    else:
+        files = glob.glob(source)
+    return sorted(os.path.abspath(file) for file in files)
+
+
+def _shard_key(path, excluded_age):
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size, excluded_age)
+
+
+# Risultati parziali di un gruppo di shard in un solo processo: i piani di tutti gli shard vengono eseguiti con
+# una sola collect_all, quindi in parallelo sul pool di thread di Polars
+def _compute_partials(paths, excluded_age):
+    return streaming.collect_partials([streaming.scan_survey(path, excluded_age) for path in paths])
+
+
+_partials = {} # Chiave dello shard -> risultati parziali (condivisi da tutte le chiamate del processo)
+_partials_lock = threading.Lock()
+
+
+# Cartella dei risultati salvati di uno shard (hash del percorso); il file path.txt contiene il percorso dello shard
+def _shard_dir(path):
+    return os.path.join(SHARD_CACHE_DIR, hashlib.sha1(path.encode()).hexdigest()[:16])
+
+
+# File dei risultati di una versione dello shard: il prefisso è l'età esclusa, così le versioni precedenti dello
+# stesso shard con la stessa età esclusa possono essere rimosse senza toccare quelle con un'altra età esclusa
+def _shard_file(key):
+    return os.path.join(_shard_dir(key[0]), f"{key[3]}.{data_cleaning._version_from_key(key)}.pkl")
+
+
+# Risultati salvati di una versione dello shard (None se mancano o non sono leggibili). I file sono scritti solo da
+# questo modulo nella cartella di cache locale (pickle: DataFrame, sketch dei quantili e accumulatori dei momenti).
+def _load_shard(key):
+    try:
+        with open(_shard_file(key), "rb") as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+# Salva i risultati di una versione dello shard (rename atomico) e rimuove quelli delle versioni precedenti
+def _store_shard(key, partial):
+    folder, target = _shard_dir(key[0]), _shard_file(key)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "path.txt"), "w") as file:
+            file.write(key[0])
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(partial, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, target)
+        for old in glob.glob(os.path.join(folder, f"{key[3]}.*.pkl")):
+            if old != target:
+                os.remove(old)
+    except OSError: # Cartella non scrivibile: i risultati restano solo in memoria
+        pass
+
+
+# Dimentica gli shard che non esistono più, in memoria e su disco
+def _evict_missing():
+    with _partials_lock:
+        for key in [key for key in _partials if not os.path.exists(key[0])]:
+            del _partials[key]
+    for folder in glob.glob(os.path.join(SHARD_CACHE_DIR, "*")):
+        try:
+            with open(os.path.join(folder, "path.txt")) as file:
+                path = file.read()
+        except OSError:
+            continue
+        if not os.path.exists(path):
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+# Risultati parziali degli shard indicati, calcolando solo quelli che mancano. Con processes = 1 tutto il lavoro è
+# affidato ai thread di Polars; con processes > 1 gli shard vengono divisi tra più processi (utile quando gli shard
+# sono molti e la parte in Python, come la costruzione degli sketch, diventa rilevante).
+def shard_partials(shards, excluded_age=data_cleaning.EXCLUDED_AGE, processes=1):
+    _evict_missing()
+    keys = [_shard_key(path, excluded_age) for path in shards]
+    with _partials_lock:
+        missing = [key for key in keys if key not in _partials]
+    loaded = {key: _load_shard(key) for key in missing} # Risultati salvati da esecuzioni precedenti
+    loaded = {key: partial for key, partial in loaded.items() if partial is not None}
+    missing = [key for key in missing if key not in loaded]
+    if missing:
+        paths = [key[0] for key in missing]
+        if processes > 1 and len(paths) > 1:
+            groups = [paths[i::processes] for i in range(min(processes, len(paths)))]
+            context = multiprocessing.get_context("spawn") # Un nuovo interprete per processo (i thread di Polars non sopravvivono a fork)
+            with ProcessPoolExecutor(len(groups), mp_context=context) as pool:
+                results = pool.map(_compute_partials, groups, [excluded_age] * len(groups))
+                computed = dict(zip([path for group in groups for path in group], [p for result in results for p in result]))
+            computed = [computed[path] for path in paths]
+        else:
+            computed = _compute_partials(paths, excluded_age)
+        for key, partial in zip(missing, computed):
+            _store_shard(key, partial)
+        loaded.update(zip(missing, computed))
+    with _partials_lock:
+        # Rimuove i risultati delle versioni precedenti degli stessi shard (con la stessa età esclusa)
+        replaced = {(key[0], key[3]) for key in loaded}
+        for old in [key for key in _partials if key not in loaded and (key[0], key[3]) in replaced]:
+            del _partials[old]
+        _partials.update(loaded)
+        return [_partials[key] for key in keys]
+
+
+# Tabelle aggregate delle pagine (stesse di streaming.compute_aggregates) calcolate shard per shard e poi unite
+def compute_aggregates(source, excluded_age=data_cleaning.EXCLUDED_AGE, processes=1, **options):
+    shards = find_shards(source)
+    if not shards:
+        raise FileNotFoundError(f"Nessuno shard trovato in {source}")
+    partials = shard_partials(shards, excluded_age, processes)
+    return streaming.finalize(streaming.merge_partials(partials), **options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tabelle aggregate delle pagine calcolate in parallelo sugli shard")
+    parser.add_argument("source", help="Cartella, pattern o file degli shard (csv, Parquet o Arrow IPC)")
+    parser.add_argument("--out", default=os.path.join(data_cleaning.CACHE_DIR, "parallel"), help="Cartella di destinazione")
+    parser.add_argument("--processes", type=int, default=1, help="Numero di processi (1: solo i thread di Polars)")
+    parser.add_argument("--excluded-age", type=int, default=data_cleaning.EXCLUDED_AGE)
+    args = parser.parse_args()
+    streaming.write_aggregates(compute_aggregates(args.source, args.excluded_age, args.processes), args.out)
+    print(f"Tabelle aggregate scritte in {args.out}")
@@ -0,0 +1,134 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+import streamlit as st
+import data_cleaning
+
+N_PERMUTATIONS = 10_000 # Numero di permutazioni predefinito
+MAX_INDEX_CELLS = 8_000_000 # Valori letti per blocco di permutazioni (limita la memoria: circa 64 MB)
+WORKERS = min(4, os.cpu_count() or 1) # Thread usati per i blocchi di permutazioni
+MAX_EXACT_ROWS = 5_000 # Oltre queste righe complete si usa l'approssimazione normale (il costo esatto cresce con permutazioni x righe)
+
+
+# Correzioni per confronti multipli: p-value aggiustati (stesso ordine di p)
+# - holm: controlla la probabilità di almeno un falso positivo (FWER), più potente di Bonferroni
+# - bh: Benjamini-Hochberg, controlla la proporzione attesa di falsi positivi tra i risultati significativi (FDR)
+def holm(p):
+    p = np.asarray(p, dtype=float)
+    order = np.argsort(p)
+    adjusted = np.maximum.accumulate((len(p) - np.arange(len(p))) * p[order])
+    result = np.empty_like(p)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+def benjamini_hochberg(p):
+    p = np.asarray(p, dtype=float)
+    order = np.argsort(p)[::-1] # Dal p-value più grande al più piccolo
+    adjusted = np.minimum.accumulate(len(p) / (len(p) - np.arange(len(p))) * p[order])
+    result = np.empty_like(p)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+CORRECTIONS = {"holm": holm, "bh": benjamini_hochberg, "none": lambda p: np.asarray(p, dtype=float)}
+
+
+# Test di permutazione per tutte le combinazioni gruppo x colonna insieme (es. 16 generi x 4 condizioni).
+# Statistica: differenza tra la media del gruppo e quella di tutti gli altri rispondenti; p-value a due code
+# (1 + permutazioni con differenza in valore assoluto almeno pari a quella osservata) / (1 + permutazioni).
+# Le righe vengono ordinate per gruppo una sola volta: permutare le etichette dei gruppi equivale a permutare i valori
+# lasciando fissi i confini dei gruppi, quindi ogni blocco di permutazioni è una matrice di indici (permutazioni x
+# righe) da cui le somme per gruppo di tutte le colonne si ottengono con un solo add.reduceat. I blocchi hanno
+# generatori derivati da seed e vengono eseguiti su un pool di thread: il risultato non dipende dal numero di thread.
+# Vengono usate solo le righe complete (gruppo e tutte le colonne non nulli).
+# Il costo è proporzionale a permutazioni x righe: oltre max_exact_rows righe il p-value viene calcolato con
+# l'approssimazione normale della stessa distribuzione di permutazione (vedi _normal_p_values), in millisecondi.
+def permutation_tests(frame, group, columns, n_permutations=N_PERMUTATIONS, seed=0, correction="holm",
+                      workers=1, variable_name="Condition", max_exact_rows=MAX_EXACT_ROWS):
+    columns = list(columns)
+    frame = frame.select(group, *columns).drop_nulls()
+    groups = frame[group].to_numpy()
+    order = np.argsort(groups, kind="stable")
+    values = frame.select(pl.col(columns).cast(pl.Float64)).to_numpy()[order] # Righe x colonne
+    keys, starts, sizes = np.unique(groups[order], return_index=True, return_counts=True)
+    n = len(values)
+    total = values.sum(axis=0)
+
+    # Differenza tra la media del gruppo e quella degli altri a partire dalle somme per gruppo (... x gruppi x colonne)
+    def differences(sums):
+        rest = np.maximum(n - sizes, 1)[:, None]
+        return sums / sizes[:, None] - (total - sums) / rest
+
+    group_sums = np.add.reduceat(values, starts, axis=0)
+    observed = differences(group_sums)
+    if n > max_exact_rows:
+        p_values = _normal_p_values(values, sizes, observed)
+    else:
+        p_values = _monte_carlo_p_values(values, starts, observed, differences, n_permutations, seed, workers)
+
+    adjusted = CORRECTIONS[correction](p_values.ravel()).reshape(p_values.shape)
+    return pl.DataFrame({
+        group: np.repeat(keys, len(columns)),
+        variable_name: np.tile(columns, len(keys)),
+        "count": np.repeat(sizes, len(columns)),
+        "mean": (group_sums / sizes[:, None]).ravel(), # Media del gruppo
+        "difference": observed.ravel(), # Media del gruppo meno media degli altri rispondenti
+        "p_value": p_values.ravel(),
+        "p_adjusted": adjusted.ravel()
+    }).sort(group, variable_name)
+
+
+# p-value stimati con n_permutations permutazioni delle etichette (matrici di indici a blocchi, vedi sopra)
+def _monte_carlo_p_values(values, starts, observed, differences, n_permutations, seed, workers):
+    n, n_columns = values.shape
+    threshold = np.abs(observed) * (1 - 1e-12) # Tolleranza per gli errori di arrotondamento nelle somme
+
+    draws = max(1, min(n_permutations, MAX_INDEX_CELLS // max(n * n_columns, 1))) # Permutazioni per blocco
+    blocks = [min(draws, n_permutations - start) for start in range(0, n_permutations, draws)]
+    generators = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(blocks))]
+
+    def run(block, rng):
+        index = rng.permuted(np.broadcast_to(np.arange(n), (block, n)), axis=1)
+        sums = np.add.reduceat(values[index], starts, axis=1) # Permutazioni x gruppi x colonne
+        return (np.abs(differences(sums)) >= threshold).sum(axis=0)
+
+    if workers > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            exceedances = sum(pool.map(run, blocks, generators))
+    else:
+        exceedances = sum(run(block, rng) for block, rng in zip(blocks, generators))
+
+    return (1 + exceedances) / (1 + n_permutations)
+
+
+# p-value a due code con l'approssimazione normale della distribuzione di permutazione: permutando le etichette la
+# somma di un gruppo di m righe su n è un campione senza reinserimento, con varianza m (n - m) / (n - 1) * varianza
+# (di popolazione) della colonna, quindi la differenza tra le medie ha varianza n^2 * varianza / (m (n - m) (n - 1)).
+# Con migliaia di righe per gruppo l'approssimazione è molto vicina al test esatto.
+def _normal_p_values(values, sizes, observed):
+    n = len(values)
+    variance = values.var(axis=0)
+    rest = np.maximum(n - sizes, 1)[:, None]
+    sd = np.sqrt(n ** 2 * variance / (sizes[:, None] * rest * max(n - 1, 1)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(sd > 0, np.abs(observed) / sd, 0.0)
+    return np.array([math.erfc(value / math.sqrt(2)) for value in z.ravel()]).reshape(z.shape)
+
+
+# Cache condivisa tra le sessioni, per versione del dataset, condizioni e parametri del test
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _genre_condition_tests(version, conditions, n_permutations, seed, correction, file_name, excluded_age):
+    data = data_cleaning.get_data_lazy(file_name, excluded_age).select("Fav genre", *conditions).collect()
+    return permutation_tests(data, "Fav genre", conditions, n_permutations, seed, correction, workers=WORKERS)
+
+
+# Test di permutazione della differenza tra la media di ogni condizione nel genere preferito e negli altri generi,
+# con p-value corretti per i confronti multipli (una riga per genere e condizione)
+def get_genre_condition_tests(conditions=("Depression", "Anxiety", "OCD", "Insomnia"), n_permutations=N_PERMUTATIONS,
+                              seed=0, correction="holm",
+                              file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _genre_condition_tests(version, tuple(conditions), n_permutations, seed, correction, file_name, excluded_age)
@@ -0,0 +1,226 @@
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import polars as pl
+import streamlit as st
+
+# Profiling attivo per tutte le sessioni (variabile d'ambiente MXMH_PROFILING=1) oppure solo per quelle aperte con
+# ?profiling=1 nell'indirizzo della pagina
+ENABLED = os.environ.get("MXMH_PROFILING", "0") == "1"
+QUERY_PARAM = "profiling"
+LOG_PATH = os.environ.get( # Log strutturato: una riga JSON per blocco misurato
+    "MXMH_PROFILING_LOG",
+    os.path.join(os.environ.get("MXMH_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mxmh_cache")), "profiling.jsonl")
+)
+HISTORY = 10 # Riesecuzioni precedenti mostrate nel pannello per confronto
+
+
+# Strumentazione delle riesecuzioni delle pagine. Ogni blocco con un nome (context manager block o decoratore
+# profiled) registra il tempo, la memoria allocata e il numero di righe prodotte; le misure di una riesecuzione
+# vengono mostrate nel pannello "Profiling" della barra laterale e aggiunte in fondo al log (righe JSON):
+# {"run", "session", "page", "block", "depth", "wall_s", "alloc_bytes", "rss_delta_bytes", "rows"}
+# - alloc_bytes: picco della memoria allocata da Python e NumPy durante il blocco (tracemalloc), non comprende
+#   i buffer di Polars e Arrow, allocati fuori da Python;
+# - rss_delta_bytes: variazione della memoria residente del processo (comprende anche Polars, solo su Linux).
+# Se il profiling non è attivo (o fuori da una pagina, es. negli script) i blocchi non misurano nulla.
+# Le misure riguardano solo il server: le trasformazioni di Vega nel browser non sono comprese.
+# tracemalloc rallenta ogni allocazione del processo: viene attivato solo mentre almeno una riesecuzione misurata è in
+# corso e fermato alla fine dell'ultima. Il picco di tracemalloc è unico per il processo, quindi con più sessioni
+# misurate nello stesso momento alloc_bytes è approssimato (comprende le allocazioni delle altre sessioni e ogni
+# sessione azzera il picco delle altre); il tempo e le righe restano esatti.
+
+_state = threading.local() # Riesecuzione in corso nel thread (ogni sessione di Streamlit esegue la pagina in un suo thread)
+_tracing_lock = threading.Lock()
+_tracing = {"runs": 0, "started": False} # Riesecuzioni misurate in corso e se tracemalloc è stato avviato da qui
+
+
+# Una riesecuzione misurata inizia: avvia tracemalloc se non è già attivo
+def _acquire_tracing():
+    with _tracing_lock:
+        _tracing["runs"] += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing["started"] = True
+
+
+# Una riesecuzione misurata finisce: con l'ultima tracemalloc viene fermato (solo se avviato da questo modulo)
+def _release_tracing():
+    with _tracing_lock:
+        _tracing["runs"] = max(_tracing["runs"] - 1, 0)
+        if _tracing["runs"] == 0 and _tracing["started"]:
+            tracemalloc.stop()
+            _tracing["started"] = False
+
+
+# Memoria residente del processo in byte (None se /proc non è disponibile)
+def _rss():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Numero di righe di un risultato: DataFrame, Series, array o contenitori di questi (somma delle righe)
+def _rows(result):
+    if isinstance(result, (pl.DataFrame, pl.Series)):
+        return len(result)
+    if hasattr(result, "shape") and len(getattr(result, "shape")) > 0:
+        return int(result.shape[0])
+    if isinstance(result, dict):
+        result = list(result.values())
+    if isinstance(result, (list, tuple)):
+        rows = [_rows(item) for item in result]
+        rows = [row for row in rows if row is not None]
+        return sum(rows) if rows else None
+    return None
+
+
+# Misura di un blocco; rows può essere impostato nel blocco con set_rows (un numero o un risultato di cui contare le righe)
+class Block:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.peak = 0
+
+    def set_rows(self, result):
+        self.rows = result if isinstance(result, int) else _rows(result)
+        return result
+
+
+def _current_run():
+    run = getattr(_state, "run", None)
+    return run if run is not None and run["enabled"] else None
+
+
+@contextmanager
+def block(name, rows=None):
+    measure = Block(name)
+    if rows is not None:
+        measure.set_rows(rows)
+    run = _current_run()
+    if run is None:
+        yield measure
+        return
+
+    stack = run["stack"]
+    # Il picco di tracemalloc è unico per il processo: prima di azzerarlo viene passato al blocco esterno
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1].peak = max(stack[-1].peak, peak)
+    tracemalloc.reset_peak()
+    stack.append(measure)
+    index = len(run["records"]) # Posto riservato subito, così i blocchi annidati seguono quello esterno
+    run["records"].append(None)
+    rss = _rss()
+    start = time.perf_counter()
+    try:
+        yield measure
+    finally:
+        wall = time.perf_counter() - start
+        stack.pop()
+        measure.peak = max(measure.peak, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, measure.peak)
+        end_rss = _rss()
+        run["records"][index] = {
+            "block": " > ".join([outer.name for outer in stack] + [name]),
+            "depth": len(stack),
+            "wall_s": wall,
+            "alloc_bytes": max(measure.peak - current, 0),
+            "rss_delta_bytes": end_rss - rss if rss is not None and end_rss is not None else None,
+            "rows": measure.rows
+        }
+
+
+# Decoratore: misura ogni chiamata della funzione come un blocco (con il nome della funzione se name manca)
+# e conta le righe del valore restituito
+def profiled(name=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with block(name or function.__name__) as measure:
+                return measure.set_rows(function(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def _session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        context = get_script_run_ctx()
+        return context.session_id if context is not None else None
+    except ImportError:
+        return None
+
+
+# Inizio di una riesecuzione della pagina: da chiamare subito dopo st.set_page_config
+def start_run(page):
+    if _current_run() is not None: # Riesecuzione precedente interrotta prima di report (es. da un'eccezione)
+        _release_tracing()
+    enabled = ENABLED or st.query_params.get(QUERY_PARAM) == "1"
+    if enabled:
+        _acquire_tracing()
+    _state.run = {
+        "enabled": enabled,
+        "page": page,
+        "run": datetime.datetime.now().isoformat(timespec="milliseconds"), # Identifica la riesecuzione (data e ora di inizio)
+        "start": time.perf_counter(),
+        "stack": [],
+        "records": []
+    }
+
+
+def _write_log(records):
+    try:
+        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+        with open(LOG_PATH, "a") as file:
+            file.writelines(json.dumps(record) + "\n" for record in records)
+    except OSError: # Cartella non scrivibile: le misure restano solo nel pannello
+        pass
+
+
+# Fine della riesecuzione: aggiunge le misure al log e le mostra nel pannello della barra laterale
+def report():
+    run = _current_run()
+    _state.run = None
+    if run is None:
+        return
+    _release_tracing()
+    total = {"block": "Totale pagina", "depth": 0, "wall_s": time.perf_counter() - run["start"],
+             "alloc_bytes": None, "rss_delta_bytes": None, "rows": None}
+    common = {"run": run["run"], "session": _session_id(), "page": run["page"]}
+    records = [{**common, **record} for record in run["records"] + [total]]
+    _write_log(records)
+
+    history = st.session_state.setdefault("profiling_history", {}).setdefault(run["page"], [])
+    history.append({"run": run["run"], "wall_s": total["wall_s"]})
+    del history[:-HISTORY]
+
+    with st.sidebar.expander("Profiling", expanded=True):
+        st.caption(f"Riesecuzione delle {run['run'][11:]}: {total['wall_s'] * 1000:.0f} ms")
+        table = pl.DataFrame(
+            [
+                {
+                    "Blocco": "  " * record["depth"] + record["block"].split(" > ")[-1],
+                    "ms": record["wall_s"] * 1000,
+                    "MB Python": record["alloc_bytes"] / 2**20 if record["alloc_bytes"] is not None else None,
+                    "MB processo": record["rss_delta_bytes"] / 2**20 if record["rss_delta_bytes"] is not None else None,
+                    "Righe": record["rows"]
+                }
+                for record in run["records"]
+            ],
+            schema={"Blocco": pl.String, "ms": pl.Float64, "MB Python": pl.Float64, "MB processo": pl.Float64, "Righe": pl.Int64}
+        )
+        st.dataframe(table, hide_index=True, column_config={
+            "ms": st.column_config.NumberColumn(format="%.1f"),
+            "MB Python": st.column_config.NumberColumn(format="%.2f"),
+            "MB processo": st.column_config.NumberColumn(format="%.2f")
+        })
+        if len(history) > 1:
+            st.caption("Riesecuzioni precedenti (ms): " + ", ".join(f"{entry['wall_s'] * 1000:.0f}" for entry in history[:-1]))
@@ -0,0 +1,185 @@
+import math
+import numpy as np
+import polars as pl
+
+COMPRESSION = 200 # Parametro di compressione del t-digest: circa COMPRESSION / 2 centroidi, errore sul rango dell'ordine di 1 / COMPRESSION
+MAX_EXACT = 10_000 # Valori distinti oltre i quali lo sketch passa dalla modalità esatta a quella approssimata
+
+
+# Quantile q (interpolazione lineare, come np.quantile e Polars) di dati descritti da valori distinti ordinati e dai
+# loro conteggi, senza dover ricostruire tutte le osservazioni. q può essere un numero o un array di probabilità.
+def histogram_quantile(values, counts, q):
+    cumulative = np.cumsum(counts)
+    position = (cumulative[-1] - 1) * np.asarray(q, dtype=float) # Posizione (da 0) nel campione ordinato
+    lower = np.floor(position)
+    upper = np.minimum(lower + 1, cumulative[-1] - 1)
+    value_lower = values[np.searchsorted(cumulative, lower, side="right")]
+    value_upper = values[np.searchsorted(cumulative, upper, side="right")]
+    return value_lower + (position - lower) * (value_upper - value_lower)
+
+
+# Compressione di un t-digest in modo vettorizzato: i punti (ordinati per valore) vengono raggruppati in centroidi in base
+# alla funzione di scala k1 = compression / (2 pi) * arcsin(2q - 1), che cresce velocemente vicino a q = 0 e q = 1:
+# nelle code i centroidi contengono pochissimi punti (spesso uno solo), al centro molti
+def _compress(means, weights, compression):
+    order = np.argsort(means, kind="stable")
+    means, weights = means[order], weights[order]
+    cumulative = np.cumsum(weights)
+    q = (cumulative - weights / 2) / cumulative[-1] # Rango (normalizzato) del centro di ogni punto
+    k = compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+    cluster = np.floor(k - k[0]).astype(np.int64)
+    new_weights = np.bincount(cluster, weights=weights)
+    new_sums = np.bincount(cluster, weights=weights * means)
+    used = new_weights > 0
+    return new_sums[used] / new_weights[used], new_weights[used]
+
+
+# Sketch dei quantili di una variabile numerica, unibile (merge) tra blocchi di righe, file o processi diversi.
+# - Modalità esatta: finché i valori distinti sono al massimo max_exact vengono tenuti i valori distinti con il loro
+#   conteggio, quindi quantili, baffi e outlier coincidono con quelli calcolati su tutti i dati.
+# - Modalità approssimata: oltre max_exact valori distinti lo sketch diventa un t-digest (centroidi con media e peso),
+#   con memoria limitata (circa compression / 2 centroidi) ed errore sul rango di ordine 1 / compression, minore nelle code.
+# I quantili usano la stessa interpolazione lineare di np.quantile e di Polars.
+class QuantileSketch:
+    def __init__(self, compression=COMPRESSION, max_exact=MAX_EXACT):
+        self.compression = compression
+        self.max_exact = max_exact
+        self.exact = True
+        self.values = np.empty(0) # Valori distinti (modalità esatta) o medie dei centroidi (modalità approssimata), ordinati
+        self.counts = np.empty(0) # Conteggi o pesi dei centroidi
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    # Aggiunge delle osservazioni (i valori nulli o NaN vengono ignorati); counts permette di passare valori con ripetizioni
+    def update(self, values, counts=None):
+        values = np.asarray(values, dtype=float)
+        counts = np.ones(len(values)) if counts is None else np.asarray(counts, dtype=float)
+        valid = ~np.isnan(values) & (counts > 0)
+        values, counts = values[valid], counts[valid]
+        if len(values) == 0:
+            return self
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self._add(values, counts, exact=True)
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._add(other.values, other.counts, other.exact)
+        return self
+
+    def copy(self):
+        result = QuantileSketch(self.compression, self.max_exact)
+        return result.merge(self)
+
+    def _add(self, values, counts, exact):
+        values = np.concatenate([self.values, values])
+        counts = np.concatenate([self.counts, counts])
+        self.exact = self.exact and exact
+        if self.exact:
+            # Somma dei conteggi dei valori uguali
+            values, inverse = np.unique(values, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts)
+            if len(values) <= self.max_exact:
+                self.values, self.counts = values, counts
+                return
+            self.exact = False
+        self.values, self.counts = _compress(values, counts, self.compression)
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    # Quantile q (numero o array di probabilità)
+    def quantile(self, q):
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan)[()]
+        if self.exact:
+            return histogram_quantile(self.values, self.counts, q)
+        # Ogni centroide viene posto al centro dei ranghi che rappresenta; gli estremi sono il minimo e il massimo esatti
+        n = self.counts.sum()
+        centers = np.cumsum(self.counts) - (self.counts + 1) / 2
+        ranks = np.concatenate([[0], centers, [n - 1]])
+        means = np.concatenate([[self.minimum], self.values, [self.maximum]])
+        return np.interp((n - 1) * np.asarray(q, dtype=float), ranks, means)[()]
+
+    # Statistiche del boxplot con le stesse regole di Vega-Lite (baffi fino al valore più estremo entro 1.5 volte lo
+    # scarto interquartile) e outlier come valori (o centroidi) con il loro conteggio
+    def box_stats(self):
+        q1, median, q3 = self.quantile([0.25, 0.5, 0.75])
+        lower_fence = q1 - 1.5 * (q3 - q1)
+        upper_fence = q3 + 1.5 * (q3 - q1)
+        values = np.concatenate([[self.minimum], self.values, [self.maximum]])
+        counts = np.concatenate([[0], self.counts, [0]]) # Minimo e massimo servono solo per i baffi
+        inside = (values >= lower_fence) & (values <= upper_fence)
+        outside = ~inside & (counts > 0)
+        stats = {
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "lower": values[inside].min(),
+            "upper": values[inside].max(),
+            "count": self.n
+        }
+        return stats, (values[outside], counts[outside])
+
+
+# Uno sketch per ogni gruppo a partire da una tabella di conteggi (colonne by, value e count_name): il conteggio dei
+# valori distinti viene fatto da Polars (anche in streaming), gli sketch ricevono solo i valori distinti
+def sketches_from_counts(counts, by, value, count_name="count", compression=COMPRESSION, max_exact=MAX_EXACT):
+    by = [by] if isinstance(by, str) else list(by)
+    sketches = {}
+    for keys, table in counts.partition_by(by, as_dict=True).items():
+        sketch = QuantileSketch(compression, max_exact)
+        sketches[keys if len(by) > 1 else keys[0]] = sketch.update(table[value].to_numpy(), table[count_name].to_numpy())
+    return sketches
+
+
+# Sketch per gruppo di un DataFrame o LazyFrame (righe con gruppo o valore nulli escluse)
+def grouped_sketches(data, by, value, compression=COMPRESSION, max_exact=MAX_EXACT):
+    by = [by] if isinstance(by, str) else list(by)
+    counts = (
+        data.filter(pl.all_horizontal(pl.col([*by, value]).is_not_null()))
+        .group_by(*by, value)
+        .agg(pl.len().alias("count"))
+    )
+    if isinstance(counts, pl.LazyFrame):
+        counts = counts.collect()
+    return sketches_from_counts(counts, by, value, compression=compression, max_exact=max_exact)
+
+
+# Unione di due dizionari gruppo -> sketch (es. calcolati su blocchi di righe o file diversi); old viene aggiornato
+def merge_grouped_sketches(old, new):
+    if old is None:
+        return {key: sketch.copy() for key, sketch in new.items()}
+    for key, sketch in new.items():
+        if key in old:
+            old[key].merge(sketch)
+        else:
+            old[key] = sketch.copy()
+    return old
+
+
+# Statistiche del boxplot a partire dagli sketch (stesse regole del boxplot di Vega-Lite: quartili e baffi fino al valore
+# più estremo entro 1.5 volte lo scarto interquartile): una tabella con le statistiche per gruppo e una con gli outlier
+# (valori distinti con conteggio), così la dimensione dei dati inviati al browser non dipende dal numero di rispondenti
+def box_stats_from_sketches(sketches, group, value):
+    rows, outlier_rows = [], []
+    for key, sketch in sketches.items():
+        stats, (values, counts) = sketch.box_stats()
+        rows.append({group: key, **stats})
+        outlier_rows += [(key, v, c) for v, c in zip(values, counts)]
+    index_type = pl.get_index_type() # Stesso tipo dei conteggi di pl.len()
+    stats = (
+        pl.DataFrame(rows, schema={group: pl.String, "q1": pl.Float64, "median": pl.Float64, "q3": pl.Float64,
+                                   "lower": pl.Float64, "upper": pl.Float64, "count": index_type})
+        .sort(group)
+    )
+    outliers = (
+        pl.DataFrame(outlier_rows, schema={group: pl.String, value: pl.Float64, "count": index_type}, orient="row")
+        .sort(group, value)
+    )
+    return stats, outliers
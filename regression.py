@@ -0,0 +1,50 @@
+import numpy as np
+import streamlit as st
+import data_cleaning
+import ingestion
+import ols
+
+FEATURES = ["Age", "Hours per day"] # Variabili esplicative del piano di regressione
+CONDITIONS = ["Depression", "Anxiety", "OCD", "Insomnia"] # Variabili risposta (una per modello, tra le colonne di ingestion.MOMENT_COLUMNS)
+
+
+# Registro dei modelli: un solo fit con risposta multipla (una colonna per condizione) e, per ogni condizione,
+# i coefficienti e la griglia del piano già predetta. Condiviso tra le sessioni e indicizzato sulla versione del dataset,
+# quindi cambiare condizione nel selettore non richiede nessun fit.
+# I modelli vengono stimati dalle statistiche sufficienti (Z'Z) mantenute da ingestion.py: quando al csv vengono
+# aggiunte nuove risposte si aggiornano solo le somme con le righe nuove e si risolvono di nuovo le equazioni normali.
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _condition_models(version, conditions, grid_steps, file_name, excluded_age):
+    state = ingestion.get_survey_state(file_name, excluded_age)
+    survey_moments = state["moments"] # Righe complete su età, ore di ascolto e condizioni
+    fit = ols.fit_ols_from_moments(survey_moments.cross_products(FEATURES + list(conditions)), len(FEATURES))
+
+    # Griglia uniforme su età e ore di ascolto, comune a tutti i piani
+    minimum = {column: survey_moments.minimum[survey_moments.columns.index(column)] for column in FEATURES}
+    maximum = {column: survey_moments.maximum[survey_moments.columns.index(column)] for column in FEATURES}
+    x_range = np.linspace(minimum["Age"], maximum["Age"], grid_steps)
+    y_range = np.linspace(minimum["Hours per day"], maximum["Hours per day"], grid_steps)
+    x_grid, y_grid = np.meshgrid(x_range, y_range)
+    z_grids = ols.predict(fit, np.c_[x_grid.ravel(), y_grid.ravel()]) # Una colonna per condizione
+
+    return {
+        condition: {
+            "intercept": fit["intercept"][i], # Intercetta
+            "coef": fit["coef"][:, i], # Coefficienti per "Age" (x1) e "Hours per day" (x2)
+            "intercept_se": fit["intercept_se"][i], # Errori standard
+            "coef_se": fit["coef_se"][:, i],
+            "r2": fit["r2"][i], # Coefficiente di determinazione
+            "n": fit["n"],
+            "x_grid": x_grid,
+            "y_grid": y_grid,
+            "z_grid": z_grids[:, i].reshape(x_grid.shape)
+        }
+        for i, condition in enumerate(conditions)
+    }
+
+
+# Restituisce il dizionario condizione -> modello (intercetta, coefficienti e griglie del piano)
+def get_condition_models(conditions=CONDITIONS, grid_steps=10,
+                         file_name=data_cleaning.FILE_NAME, excluded_age=data_cleaning.EXCLUDED_AGE):
+    version = data_cleaning.get_data_version(file_name, excluded_age)
+    return _condition_models(version, tuple(conditions), grid_steps, file_name, excluded_age)
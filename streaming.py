@@ -0,0 +1,300 @@
+import argparse
+import glob
+import os
+import numpy as np
+import polars as pl
+import aggregates
+import data_cleaning
+import ingestion
+import kde
+import moments
+import quantiles
+
+ENGINE = "streaming" # Motore di Polars che elabora i dati a blocchi (memoria limitata, indipendente dal numero di righe)
+PSYCH_CONDITIONS = ["Anxiety", "Depression", "Insomnia", "OCD"] # Condizioni della pagina sulle condizioni psichiche
+CUBE_CONDITIONS = ["Depression", "Anxiety", "OCD", "Insomnia"] # Condizioni della heatmap della pagina incrociata
+
+
+# Calcolo di tutte le tabelle aggregate delle pagine per export troppo grandi per essere caricati in memoria
+# (es. più ondate del questionario unite, decine di GB). I dati vengono letti a blocchi con il motore streaming di Polars
+# e ogni piano produce solo tabelle piccole: conteggi, somme e prodotti incrociati, oppure valori distinti con il loro
+# conteggio. Le statistiche che richiederebbero tutti i valori in memoria (mediane, quartili, baffi, densità) vengono
+# calcolate a partire dai valori distinti e dai conteggi (vedi quantiles.py), con gli stessi risultati del calcolo in memoria.
+
+
+# Piano lazy sui file dell'export: un percorso o un pattern (es. "ondate/*.csv"), in csv, Parquet o Arrow IPC,
+# con gli stessi tipi e la stessa pulizia di data_cleaning. I file Parquet (o una cartella) possono avere il layout
+# Hive di data_cleaning.get_data_partitioned: le colonne di partizione vengono ricavate dai nomi delle cartelle.
+def scan_survey(source, excluded_age=data_cleaning.EXCLUDED_AGE):
+    extension = os.path.splitext(source)[1].lower()
+    if extension == ".parquet" or os.path.isdir(source):
+        data = pl.scan_parquet(source, hive_partitioning=True)
+    elif extension in (".arrow", ".ipc", ".feather"):
+        data = pl.scan_ipc(source)
+    else:
+        data = pl.scan_csv(source, schema_overrides=data_cleaning.DTYPES)
+    return data.filter(pl.col("Age") != excluded_age) # Rimozione outlier
+
+
+# Conteggio dei valori distinti di value per gruppo (tabella piccola anche con miliardi di righe)
+def _value_counts_plan(data, by, value):
+    return (
+        data.filter(pl.all_horizontal(pl.col([*by, value]).is_not_null())) # Rimuove i valori nulli
+        .group_by(*by, value)
+        .agg(pl.len().alias("count"))
+    )
+
+
+# Cubo delle frequenze di ascolto come aggregates._frequency_cube_plan: un conteggio per ogni colonna
+# "Frequency [genere]" (invece di un unpivot di tutte le righe) e unione delle tabelle dei conteggi
+def _frequency_counts_plans(data):
+    frequency_columns = [col for col in data.collect_schema().names() if col.startswith("Frequency [")]
+    return [
+        data.group_by(pl.col(col).alias("Frequenza"))
+        .agg(pl.len().alias("Conteggio"))
+        .select(pl.lit(col.replace("Frequency [", "").replace("]", "")).alias("Genere"), "Frequenza", "Conteggio")
+        for col in frequency_columns
+    ]
+
+
+def _frequency_cube_from_counts(counts):
+    genres = counts["Genere"].unique(maintain_order=True).to_list() # Generi nell'ordine delle colonne
+    return (
+        counts.with_columns(
+            (pl.col("Conteggio") / pl.col("Conteggio").sum().over("Genere") * 100).alias("Percentuale") # Percentuale sul totale del genere
+        )
+        .sort(pl.col("Genere").cast(pl.Enum(genres)), "Frequenza", nulls_last=True)
+    )
+
+
+# Cubo (genere preferito x condizione) come aggregates._genre_condition_cube_plan, a partire dai conteggi dei livelli
+def _genre_condition_counts_plan(data, conditions):
+    return (
+        data.filter(pl.col("Fav genre").is_not_null() & pl.all_horizontal(pl.col(conditions).is_not_null())) # Rimuove i valori nulli
+        .unpivot(index=["Fav genre"], on=conditions, variable_name="Condition", value_name="Level")
+        .group_by("Fav genre", "Condition", "Level")
+        .agg(pl.len().alias("count"))
+    )
+
+
+# Mediane per gruppo dagli sketch dei quantili (esatte finché i valori distinti sono pochi, come i livelli da 0 a 10)
+def _grouped_medians(counts, by, value):
+    sketches = quantiles.sketches_from_counts(counts, by, value)
+    return pl.DataFrame(
+        [(*keys, sketch.quantile(0.5)) for keys, sketch in sketches.items()],
+        schema=[*by, "median"], orient="row"
+    )
+
+
+def _genre_condition_cube_from_counts(counts, confidence):
+    by = ["Fav genre", "Condition"]
+    mean = (pl.col("Level") * pl.col("count")).sum().over(by) / pl.col("count").sum().over(by)
+    cube = (
+        counts.with_columns(mean.alias("mean"))
+        .group_by(by)
+        .agg(
+            pl.col("count").sum(),
+            pl.col("mean").first(),
+            ((pl.col("Level") - pl.col("mean")) ** 2 * pl.col("count")).sum().alias("variance")
+        )
+        .with_columns(pl.col("variance") / (pl.col("count") - 1))
+        .join(_grouped_medians(counts, by, "Level"), on=by)
+        .sort(by)
+    )
+    return aggregates._add_confidence_interval(cube, confidence)
+
+
+# Statistiche sufficienti (Z'Z, minimi e massimi) delle righe complete sulle colonne indicate: un solo passaggio
+# con somme di prodotti, restituito come moments.MomentAccumulator (uguale a quello dell'ingestione incrementale)
+def _moments_plan(data, columns):
+    values = [pl.col(col).cast(pl.Float64) for col in columns]
+    products = [
+        (values[i] * values[j]).sum().alias(f"{i}_{j}")
+        for i in range(len(columns)) for j in range(i, len(columns))
+    ]
+    return (
+        data.select(columns)
+        .drop_nulls()
+        .select(
+            pl.len().cast(pl.Float64).alias("n"),
+            *[value.sum().alias(f"sum_{i}") for i, value in enumerate(values)],
+            *products,
+            *[value.min().alias(f"min_{i}") for i, value in enumerate(values)],
+            *[value.max().alias(f"max_{i}") for i, value in enumerate(values)]
+        )
+    )
+
+
+def _moments_from_row(row, columns):
+    accumulator = moments.MomentAccumulator(columns)
+    if row["n"] == 0:
+        return accumulator
+    k = len(columns)
+    accumulator.zz[0, 0] = row["n"]
+    for i in range(k):
+        accumulator.zz[0, i + 1] = accumulator.zz[i + 1, 0] = row[f"sum_{i}"]
+        accumulator.minimum[i] = row[f"min_{i}"]
+        accumulator.maximum[i] = row[f"max_{i}"]
+        for j in range(i, k):
+            accumulator.zz[i + 1, j + 1] = accumulator.zz[j + 1, i + 1] = row[f"{i}_{j}"]
+    return accumulator
+
+
+# Tabelle additive dei risultati parziali: nome -> colonne chiave (le altre colonne sono conteggi o somme).
+# I risultati parziali di blocchi o file diversi si uniscono sommando queste tabelle, unendo gli sketch dei quantili
+# e sommando le statistiche sufficienti (vedi merge_partials).
+PARTIAL_KEYS = {
+    "age": ["Age"],
+    "platform": ["Primary streaming service"],
+    "genre": ["Fav genre"],
+    "music_effects": ["Music effects"],
+    "frequency": ["Genere", "Frequenza"],
+    "genre_condition": ["Fav genre", "Condition", "Level"],
+    "condition": ["Condition", "Value"]
+}
+
+
+# Piani lazy dei risultati parziali di un insieme di righe: solo conteggi, somme e valori distinti con il loro conteggio
+def partial_plans(data):
+    by, values = ingestion.GROUPED_SUMS["age"] # Conteggi e somme per età (istogramma, età escluse, ore medie, grafico a bolle)
+    return {
+        "age": moments.grouped_sums(data, by, values),
+        "platform": data.group_by("Primary streaming service").agg(pl.len().alias("count")),
+        "genre": data.group_by("Fav genre").agg(pl.len().alias("count")),
+        "music_effects": data.group_by("Music effects").agg(pl.len().alias("count")),
+        "frequency": pl.concat(_frequency_counts_plans(data)),
+        "genre_condition": _genre_condition_counts_plan(data, CUBE_CONDITIONS),
+        "condition": (
+            data.select(PSYCH_CONDITIONS)
+            .unpivot(on=PSYCH_CONDITIONS, variable_name="Condition", value_name="Value")
+            .group_by("Condition", "Value")
+            .agg(pl.len().alias("count"))
+        ),
+        "hours": _value_counts_plan(data, ["Fav genre"], "Hours per day"),
+        "moments": _moments_plan(data, ingestion.MOMENT_COLUMNS)
+    }
+
+
+# Esegue i piani parziali di più insiemi di righe (es. un file per ondata) con una sola collect_all: i piani vengono
+# eseguiti in parallelo dal pool di thread di Polars. Restituisce un dizionario di risultati parziali per ogni insieme,
+# con le ore di ascolto già riassunte negli sketch dei quantili per genere.
+def collect_partials(datas):
+    plans = [partial_plans(data) for data in datas]
+    frames = pl.collect_all([plan for shard in plans for plan in shard.values()], engine=ENGINE)
+    partials = []
+    for i, shard in enumerate(plans):
+        partial = dict(zip(shard, frames[i * len(shard):(i + 1) * len(shard)]))
+        partial["hours"] = quantiles.sketches_from_counts(partial["hours"], "Fav genre", "Hours per day")
+        partial["moments"] = _moments_from_row(partial["moments"].row(0, named=True), ingestion.MOMENT_COLUMNS)
+        partials.append(partial)
+    return partials
+
+
+# Unisce i risultati parziali (l'ordine dei gruppi è quello di prima apparizione, come per i generi delle frequenze)
+def merge_partials(partials):
+    merged = {
+        name: (
+            pl.concat([partial[name] for partial in partials], how="vertical_relaxed")
+            .group_by(keys, maintain_order=True)
+            .agg(pl.all().sum())
+        )
+        for name, keys in PARTIAL_KEYS.items()
+    }
+    merged["hours"] = None
+    merged["moments"] = moments.MomentAccumulator(ingestion.MOMENT_COLUMNS)
+    for partial in partials:
+        merged["hours"] = quantiles.merge_grouped_sketches(merged["hours"], partial["hours"])
+        merged["moments"].merge(partial["moments"])
+    return merged
+
+
+# Tabelle delle pagine a partire dai risultati parziali (stessi nomi e stesse colonne di aggregates e delle pagine)
+def finalize(partial, confidence=0.95, density_extent=(-3, 14), density_steps=171):
+    age = partial["age"]
+    results = {
+        # Istogramma delle età fino a 70 anni e tabella delle età escluse
+        "data_age_hist": (
+            age.filter(pl.col("Age") <= 70)
+            .select("Age", pl.col("count").alias("Count"))
+            .with_columns((pl.col("Count") / pl.col("Count").sum() * 100).alias("Percentage"))
+        ),
+        "freq_removed": age.filter(pl.col("Age") > 70).select("Age", pl.col("count").alias("Frequency")).sort("Age"),
+        "data_platform_pie": (
+            partial["platform"].filter(pl.col("Primary streaming service").is_not_null())
+            .select("Primary streaming service", pl.col("count").alias("Users"))
+            .with_columns((pl.col("Users") / pl.col("Users").sum() * 100).alias("Percentage"))
+            .with_columns((pl.col("Percentage").round(2).cast(pl.String) + "%").alias("Percentage_Label"))
+        ),
+        # Ore medie di ascolto per età (media dei soli valori non nulli, come pl.mean)
+        "processed_data": (
+            age.select(
+                "Age",
+                pl.when(pl.col("Hours per day_count") > 0)
+                .then(pl.col("Hours per day_sum") / pl.col("Hours per day_count"))
+                .alias("Avg hours per day")
+            )
+            .sort("Age")
+        ),
+        "genre_counts": (
+            partial["genre"].select("Fav genre", pl.col("count").alias("Conteggio"))
+            .with_columns((pl.col("Conteggio") / pl.col("Conteggio").sum() * 100).alias("Percentuale"))
+            .sort("Conteggio", descending=True)
+        ),
+        "music_effects_counts": (
+            partial["music_effects"].filter(pl.col("Music effects").is_not_null())
+            .with_columns((pl.col("count") / pl.col("count").sum()).alias("percentage"))
+        ),
+        "frequency_cube": _frequency_cube_from_counts(partial["frequency"]),
+        "genre_condition_cube": _genre_condition_cube_from_counts(partial["genre_condition"], confidence),
+        "condition_densities": kde.kde_table_from_counts(
+            partial["condition"], PSYCH_CONDITIONS, extent=density_extent, steps=density_steps
+        ),
+        "grouped_age": age,
+        "moments": partial["moments"]
+    }
+    stats, outliers = quantiles.box_stats_from_sketches(partial["hours"], "Fav genre", "Hours per day")
+    results["order"] = aggregates.genre_order(stats)
+    results["hours_boxplot_stats"] = stats
+    results["hours_boxplot_outliers"] = outliers
+    return results
+
+
+# Calcola tutte le tabelle aggregate delle tre pagine con un solo passaggio streaming sui dati (i piani vengono
+# eseguiti insieme, quindi ogni file viene letto una volta). Restituisce un dizionario nome -> DataFrame;
+# "moments" è il moments.MomentAccumulator delle colonne di ingestion.MOMENT_COLUMNS (correlazioni e regressioni).
+# Le densità delle condizioni usano gli stessi parametri della pagina (estensione [-3, 14] con passo 0.1).
+def compute_aggregates(source, excluded_age=data_cleaning.EXCLUDED_AGE, confidence=0.95,
+                       density_extent=(-3, 14), density_steps=171):
+    partial = collect_partials([scan_survey(source, excluded_age)])[0]
+    return finalize(partial, confidence, density_extent, density_steps)
+
+
+# Salva le tabelle in formato Arrow IPC (una per nome); le statistiche sufficienti vengono salvate come matrice Z'Z
+# in formato long (riga, colonna, valore) insieme a minimi e massimi
+def write_aggregates(results, folder):
+    os.makedirs(folder, exist_ok=True)
+    for name, table in results.items():
+        if isinstance(table, moments.MomentAccumulator):
+            labels = ["n", *table.columns]
+            table = pl.DataFrame({
+                "row": np.repeat(labels, len(labels)),
+                "column": np.tile(labels, len(labels)),
+                "value": table.zz.ravel()
+            }).vstack(pl.DataFrame({
+                "row": ["min"] * len(table.columns) + ["max"] * len(table.columns),
+                "column": table.columns * 2,
+                "value": np.concatenate([table.minimum, table.maximum])
+            }))
+        table.write_ipc(os.path.join(folder, f"{name}.arrow"), compression="uncompressed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tabelle aggregate delle pagine calcolate in streaming")
+    parser.add_argument("source", nargs="?", default=data_cleaning.get_data_path(), help="File o pattern (csv, Parquet o Arrow IPC)")
+    parser.add_argument("--out", default=os.path.join(data_cleaning.CACHE_DIR, "streaming"), help="Cartella di destinazione")
+    parser.add_argument("--excluded-age", type=int, default=data_cleaning.EXCLUDED_AGE)
+    args = parser.parse_args()
+    if not glob.glob(args.source):
+        parser.error(f"nessun file trovato: {args.source}")
+    write_aggregates(compute_aggregates(args.source, args.excluded_age), args.out)
+    print(f"Tabelle aggregate scritte in {args.out}")
@@ -0,0 +1,207 @@
+import argparse
+import os
+from statistics import NormalDist
+import numpy as np
+import polars as pl
+import data_cleaning
+import moments
+
+CHUNK_ROWS = 1_000_000 # Righe generate e scritte per volta (la memoria usata non dipende dal numero totale di righe)
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S" # Formato della colonna Timestamp nel csv
+TIMESTAMP_OUTPUT_FORMAT = "%-m/%-d/%Y %-H:%M:%S" # Stesso formato senza zeri iniziali in mese, giorno e ora (es. 8/27/2022 9:03:02)
+
+# Variabili ordinali: valori dal più basso al più alto
+FREQUENCY_LEVELS = ["Never", "Rarely", "Sometimes", "Very frequently"]
+YES_NO = ["No", "Yes"]
+MUSIC_EFFECTS = ["Worsen", "No effect", "Improve"]
+NUMERIC_COLUMNS = ["Age", "Hours per day", "BPM", "Anxiety", "Depression", "Insomnia", "OCD"]
+BINARY_COLUMNS = ["While working", "Instrumentalist", "Composer", "Exploratory", "Foreign languages"]
+
+
+# Generatore di dati sintetici con lo stesso schema del questionario (33 colonne), stimato dal csv originale.
+# Le variabili numeriche e ordinali (età, ore, BPM, condizioni, Sì/No, livelli di frequenza, effetti della musica)
+# vengono generate con una copula gaussiana: ogni colonna ha la distribuzione empirica del csv (età concentrata sui
+# giovani, ore di ascolto asimmetriche, livelli di frequenza) e le dipendenze tra colonne sono le correlazioni dei
+# punteggi normali (es. circa 0.5 tra ansia e depressione). Il genere preferito viene scelto in base ai livelli di
+# frequenza generati (chi ascolta "Very frequently" un genere lo indica più spesso come preferito), la piattaforma
+# con la sua distribuzione marginale. Anche la quota di valori mancanti di ogni colonna è quella del csv.
+class SurveyModel:
+    def __init__(self, data):
+        self.columns = data.columns
+        self.schema = data.schema
+        self.frequency_columns = [col for col in self.columns if col.startswith("Frequency [")]
+        self.genres = [col.replace("Frequency [", "").replace("]", "") for col in self.frequency_columns]
+        self.copula_columns = NUMERIC_COLUMNS + BINARY_COLUMNS + self.frequency_columns + ["Music effects"]
+        self.null_rates = {col: data[col].null_count() / data.height for col in self.columns}
+
+        codes = data.select(self._codes(col) for col in self.copula_columns)
+
+        # Distribuzione empirica di ogni colonna: valori distinti, probabilità cumulate e soglie sulla normale standard
+        normal = NormalDist()
+        self.values, self.thresholds, scores = {}, {}, []
+        for col in self.copula_columns:
+            counts = codes[col].drop_nulls().value_counts().sort(col)
+            values = counts[col].to_numpy()
+            probabilities = counts["count"].to_numpy() / counts["count"].sum()
+            cumulative = np.cumsum(probabilities)
+            self.values[col] = values
+            self.thresholds[col] = np.array([normal.inv_cdf(p) for p in cumulative[:-1]])
+            # Punteggio normale di ogni valore: quantile della normale al centro della sua probabilità
+            midpoints = {value: normal.inv_cdf(c - p / 2) for value, c, p in zip(values, cumulative, probabilities)}
+            scores.append(codes[col].replace_strict(midpoints, default=None, return_dtype=pl.Float64).alias(col))
+
+        # Correlazioni dei punteggi normali (valori mancanti gestiti a coppie) rese definite positive
+        correlation = moments.pairwise_moments(pl.DataFrame(scores), self.copula_columns).correlation()
+        correlation = np.nan_to_num(correlation, nan=0.0)
+        np.fill_diagonal(correlation, 1.0)
+        eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+        correlation = eigenvectors @ np.diag(np.maximum(eigenvalues, 1e-6)) @ eigenvectors.T
+        scale = np.sqrt(np.diag(correlation))
+        self.correlation = correlation / np.outer(scale, scale)
+        self.cholesky = np.linalg.cholesky(self.correlation)
+
+        # Genere preferito: probabilità marginale di ogni genere e peso di ogni livello di frequenza del genere stesso
+        # (rapporto tra la distribuzione dei livelli per il genere preferito e quella di tutti i generi)
+        genre_counts = data["Fav genre"].drop_nulls().value_counts()
+        genre_counts = dict(zip(genre_counts["Fav genre"], genre_counts["count"]))
+        self.genre_prior = np.array([genre_counts.get(genre, 0) for genre in self.genres], dtype=float)
+        self.genre_prior /= self.genre_prior.sum()
+        levels = codes.select(self.frequency_columns).to_numpy()
+        favourite = np.array([self.genres.index(g) if g in self.genres else -1 for g in data["Fav genre"].to_list()])
+        rows = favourite >= 0
+        favourite_levels = levels[np.flatnonzero(rows), favourite[rows]]
+        all_levels = levels[~np.isnan(levels)]
+        favourite_share = np.bincount(favourite_levels[~np.isnan(favourite_levels)].astype(int), minlength=4) + 1
+        all_share = np.bincount(all_levels.astype(int), minlength=4) + 1
+        self.level_weights = (favourite_share / favourite_share.sum()) / (all_share / all_share.sum())
+
+        self._calibrate_genres()
+
+        services = data["Primary streaming service"].drop_nulls().value_counts()
+        self.services = services["Primary streaming service"].to_numpy()
+        self.service_probabilities = services["count"].to_numpy() / services["count"].sum()
+
+        timestamps = data["Timestamp"].str.strptime(pl.Datetime("us"), TIMESTAMP_FORMAT, strict=False)
+        self.start, self.end = timestamps.min(), timestamps.max()
+
+    # Codici numerici delle variabili ordinali (le altre colonne restano come sono)
+    def _codes(self, col):
+        if col in BINARY_COLUMNS:
+            return pl.col(col).replace_strict(YES_NO, list(range(len(YES_NO))), default=None, return_dtype=pl.Float64)
+        if col.startswith("Frequency ["):
+            return pl.col(col).replace_strict(FREQUENCY_LEVELS, list(range(len(FREQUENCY_LEVELS))), default=None, return_dtype=pl.Float64)
+        if col == "Music effects":
+            return pl.col(col).replace_strict(MUSIC_EFFECTS, list(range(len(MUSIC_EFFECTS))), default=None, return_dtype=pl.Float64)
+        return pl.col(col).cast(pl.Float64)
+
+    def _genre_weights(self, levels):
+        return self.genre_weights[None, :] * self.level_weights[levels]
+
+    def _sample_genres(self, levels, rng):
+        cumulative = np.cumsum(self._genre_weights(levels), axis=1)
+        draw = rng.random(len(levels))[:, None] * cumulative[:, -1:]
+        return np.minimum((cumulative < draw).sum(axis=1), len(self.genres) - 1)
+
+    # Pesi dei generi calibrati (iterative proportional fitting su un campione dei livelli di frequenza) in modo che
+    # la distribuzione dei generi preferiti generati coincida con quella del csv
+    def _calibrate_genres(self, rows=100_000, iterations=20):
+        rng = np.random.default_rng(0)
+        latent = self.cholesky @ rng.standard_normal((len(self.copula_columns), rows))
+        levels = np.column_stack([
+            self.values[col][np.searchsorted(self.thresholds[col], latent[self.copula_columns.index(col)])]
+            for col in self.frequency_columns
+        ]).astype(int)
+        self.genre_weights = self.genre_prior.copy()
+        for _ in range(iterations):
+            weights = self._genre_weights(levels)
+            expected = (weights / weights.sum(axis=1, keepdims=True)).mean(axis=0)
+            self.genre_weights *= np.divide(self.genre_prior, expected, out=np.zeros_like(expected), where=expected > 0)
+
+    # Genera rows righe (offset e total servono per distribuire i Timestamp in ordine crescente su più blocchi)
+    def sample(self, rows, rng, offset=0, total=None):
+        total = total or rows
+        latent = self.cholesky @ rng.standard_normal((len(self.copula_columns), rows)) # Una riga contigua per colonna
+        generated = {}
+        for j, col in enumerate(self.copula_columns):
+            generated[col] = self.values[col][np.searchsorted(self.thresholds[col], latent[j])]
+
+        # Genere preferito in base ai livelli di frequenza appena generati
+        levels = np.column_stack([generated[col] for col in self.frequency_columns]).astype(int)
+        genre = self._sample_genres(levels, rng)
+
+        # Timestamp crescenti tra il primo e l'ultimo del csv
+        span = (self.end - self.start).total_seconds()
+        seconds = (offset + np.arange(rows) + rng.random(rows)) / total * span
+
+        # Le colonne di testo vengono create con gather dalle etichette (molto più veloce di array di stringhe NumPy)
+        def labels(values, codes):
+            return pl.Series(values, dtype=pl.String).gather(codes.astype(np.int64))
+
+        columns = {
+            "Timestamp": (
+                pl.Series(np.datetime64(self.start, "us") + (seconds * 1e6).astype("timedelta64[us]"))
+                .dt.strftime(TIMESTAMP_OUTPUT_FORMAT)
+            ),
+            "Primary streaming service": labels(self.services, rng.choice(len(self.services), rows, p=self.service_probabilities)),
+            "Fav genre": labels(self.genres, genre),
+            "Permissions": labels(["I understand."], np.zeros(rows))
+        }
+        for col in self.copula_columns:
+            if col in BINARY_COLUMNS:
+                columns[col] = labels(YES_NO, generated[col])
+            elif col.startswith("Frequency ["):
+                columns[col] = labels(FREQUENCY_LEVELS, generated[col])
+            elif col == "Music effects":
+                columns[col] = labels(MUSIC_EFFECTS, generated[col])
+            else:
+                columns[col] = generated[col]
+
+        frame = pl.DataFrame({col: columns[col] for col in self.columns}).cast(self.schema)
+        # Valori mancanti con la stessa frequenza del csv
+        return frame.with_columns(
+            pl.when(pl.lit(rng.random(rows) >= rate)).then(pl.col(col)).alias(col)
+            for col, rate in self.null_rates.items() if rate > 0
+        )
+
+
+# Modello stimato dal csv (letto con i tipi di data_cleaning, senza rimuovere l'outlier)
+def fit_model(file_name=data_cleaning.FILE_NAME):
+    data = pl.read_csv(data_cleaning.get_data_path(file_name), schema_overrides=data_cleaning.DTYPES)
+    return SurveyModel(data)
+
+
+# Scrive rows righe sintetiche a blocchi di chunk_rows, senza tenerle mai tutte in memoria.
+# Il formato dipende dall'estensione: .csv (un solo file, i blocchi vengono aggiunti in fondo), .parquet o .arrow/.ipc
+# (una cartella con un file per blocco, leggibile con pl.scan_parquet / pl.scan_ipc o come shard da parallel.py).
+def generate(path, rows, chunk_rows=CHUNK_ROWS, seed=0, model=None):
+    model = model or fit_model()
+    rng = np.random.default_rng(seed)
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in (".csv", ".parquet", ".arrow", ".ipc"):
+        raise ValueError(f"Formato non supportato: {extension}")
+    if extension == ".csv":
+        with open(path, "wb") as file:
+            for i, offset in enumerate(range(0, rows, chunk_rows)):
+                chunk = model.sample(min(chunk_rows, rows - offset), rng, offset, rows)
+                chunk.write_csv(file, include_header=i == 0)
+        return path
+    os.makedirs(path, exist_ok=True)
+    for i, offset in enumerate(range(0, rows, chunk_rows)):
+        chunk = model.sample(min(chunk_rows, rows - offset), rng, offset, rows)
+        part = os.path.join(path, f"part-{i:05d}{extension}")
+        if extension == ".parquet":
+            chunk.write_parquet(part)
+        else:
+            chunk.write_ipc(part)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera dati sintetici con lo schema del questionario")
+    parser.add_argument("path", help="File .csv oppure cartella .parquet / .arrow")
+    parser.add_argument("--rows", type=int, required=True, help="Numero di righe")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Righe per blocco")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.rows, args.chunk_rows, args.seed)
+    print(f"{args.rows} righe scritte in {args.path}")